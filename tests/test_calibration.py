@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("mass")
+from ucalpost.tes.calibration import (  # noqa: E402
+    assignPeaks,
+    getAccuracyEstimates,
+    getBestAssignment,
+    getPeakCombinations,
+)
+
+
+@pytest.mark.parametrize("nlines", [2, 3, 4, 5])
+@pytest.mark.parametrize("curvename", ["gain", "loglog", "loggain", "linear"])
+def test_best_assignment_matches_exhaustive(nlines, curvename):
+    rng = np.random.default_rng(nlines)
+    for _ in range(50):
+        energies = np.sort(rng.uniform(200, 2000, nlines))
+        npos = nlines + rng.integers(0, 4)
+        positions = rng.uniform(1000, 20000, npos)
+        autoinclude = int(rng.integers(0, 2))
+        combos = getPeakCombinations(positions, nlines, autoinclude)
+        _, expected_rms, _ = getAccuracyEstimates(energies, combos, curvename, 2)
+        peaks, rms = getBestAssignment(energies, positions, autoinclude, curvename, 2)
+        assert rms == pytest.approx(expected_rms, rel=1e-8, abs=1e-12)
+        # Ties may pick different peaks, but they must have the best RMS
+        _, peaks_rms, _ = getAccuracyEstimates(
+            energies, np.atleast_2d(peaks), curvename, 2
+        )
+        assert peaks_rms == pytest.approx(expected_rms, rel=1e-8, abs=1e-12)
+
+
+@pytest.mark.parametrize("npos", [0, 1, 2, 3])
+def test_best_assignment_too_few_peaks(npos):
+    energies = np.array([277.0, 392.0, 525.0, 776.0])
+    positions = np.linspace(1000, 5000, npos)
+    with pytest.raises(ValueError):
+        getBestAssignment(energies, positions, min(npos, 1))
+    with pytest.raises(ValueError):
+        assignPeaks(positions, list(energies))
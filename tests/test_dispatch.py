@@ -0,0 +1,63 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("mass")
+import ucalpost.dispatch as dispatch  # noqa: E402
+
+
+class StubLoader:
+    def __init__(self, catalog):
+        self.closed = False
+        self.pool = self
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def stub_runs(monkeypatch):
+    """
+    Runs are their stop documents, each run's OFF file is doc["off"], and
+    process_run records the OFF files being processed at the same time
+    """
+    state = {"active": [], "overlap": False, "processed": []}
+    lock = threading.Lock()
+
+    def process_run(run, catalog, loader, **kwargs):
+        assert not loader.closed
+        with lock:
+            if run["off"] in state["active"]:
+                state["overlap"] = True
+            state["active"].append(run["off"])
+        time.sleep(0.01)
+        with lock:
+            state["active"].remove(run["off"])
+            state["processed"].append(run["run_start"])
+
+    monkeypatch.setattr(dispatch, "getRunFromStop", lambda doc, catalog: doc)
+    monkeypatch.setattr(dispatch, "get_filename", lambda run: run["off"])
+    monkeypatch.setattr(dispatch, "AnalysisLoader", StubLoader)
+    monkeypatch.setattr(dispatch, "process_run", process_run)
+    return state
+
+
+@pytest.mark.parametrize("workers, max_loaders", [(2, 1), (5, 4), (3, 2)])
+def test_local_dispatch(stub_runs, workers, max_loaders):
+    docs = [
+        ("stop", {"run_start": f"run{n}", "off": f"off{n % (workers + 1)}"})
+        for n in range(40)
+    ]
+    handler = dispatch.dispatch(
+        {},
+        workers=workers,
+        dispatcher=dispatch.LocalDispatcher(docs),
+        max_loaders=max_loaders,
+    )
+    stats = handler.stats()
+    assert stats["failed"] == 0
+    assert stats["processed"] == 40
+    assert sorted(stub_runs["processed"]) == sorted(d["run_start"] for _, d in docs)
+    assert not stub_runs["overlap"]
+    assert len(handler._loaders) <= max_loaders
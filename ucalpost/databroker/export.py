@@ -178,13 +178,9 @@ def get_tes_data(run, rois, channels=None):
     rois : dictionary of {roi_name: (llim, ulim)}
     """
     d = scandata_from_run(run)
-    tes_data = []
-    tes_keys = []
-    for roi in rois:
-        llim, ulim = rois[roi]
-        tes_keys.append(roi)
-        y, x = d.getScan1d(llim, ulim, channels=channels)
-        tes_data.append(y)
+    tes_keys = list(rois)
+    counts, _ = d.getScan1dRois([rois[k] for k in tes_keys], channels=channels)
+    tes_data = [counts[:, n] for n in range(len(tes_keys))]
     return tes_keys, tes_data
 
 
@@ -1,22 +1,277 @@
-def getDocumentHandler():
-    loader = AnalysisLoader()
+import queue
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from .databroker.run import getRunFromStop, get_filename
+from .tes.loader import AnalysisLoader, process_run
 
-    def _handler(name, doc):
+"""
+Live processing of runs as their stop documents arrive
+"""
+
+
+class LiveProcessor:
+    """
+    Document handler that queues runs for processing as their stop documents
+    arrive, and processes them in a pool of worker threads, so that a slow
+    calibration never blocks document consumption.
+
+    Requests for a run that is already queued are coalesced, and a request
+    for a run that is being processed is re-queued once it finishes. Runs
+    from the same OFF file are processed one at a time, sharing an
+    AnalysisLoader so that the open ChannelGroup is reused.
+    """
+
+    def __init__(
+        self, catalog, workers=1, maxsize=100, max_loaders=4, history=100, **kwargs
+    ):
+        """
+        catalog : the catalog that stop documents are looked up in
+        workers : number of runs to process concurrently
+        maxsize : maximum number of queued runs. Further stop documents block
+                  the caller until there is room.
+        max_loaders : number of AnalysisLoaders, one per OFF file, to keep
+        history : number of recent runs kept for the latency statistics
+        **kwargs : passed to process_run
+        """
+        self.catalog = catalog
+        self.workers = workers
+        self.max_loaders = max_loaders
+        self.kwargs = kwargs
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._outstanding = 0
+        self._pending = {}
+        self._running = set()
+        self._rerun = {}
+        # Reruns are queued here rather than on the bounded queue, so that a
+        # worker never blocks on its own queue
+        self._reruns = deque()
+        self._loaders = OrderedDict()
+        self._threads = []
+        self._latency = deque(maxlen=history)
+        self._duration = deque(maxlen=history)
+        self.processed = 0
+        self.failed = 0
+        self.coalesced = 0
+
+    def __call__(self, name, doc):
         if name == "stop":
-            # run_analysis(stop)
-            run = getRunFromStop(doc)
-            run_analysis(run, loader)
-        else:
-            print(name)
-    return _handler
+            self.submit(doc)
+
+    def submit(self, doc):
+        """
+        Queue the run of a stop document for processing
+        """
+        uid = doc["run_start"]
+        with self._lock:
+            if uid in self._pending:
+                self._pending[uid] = (doc, self._pending[uid][1])
+                self.coalesced += 1
+                return
+            if uid in self._running:
+                self._rerun[uid] = doc
+                self.coalesced += 1
+                return
+            self._pending[uid] = (doc, time.monotonic())
+            self._outstanding += 1
+        self._queue.put(uid)
+
+    def start(self):
+        """
+        Start the worker threads
+        """
+        for n in range(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, wait=True):
+        """
+        Stop the worker threads after the runs already queued are processed
+        """
+        for thread in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def join(self):
+        """
+        Block until every queued run has been processed
+        """
+        with self._idle:
+            while self._outstanding:
+                self._idle.wait()
+
+    def _loader(self, off_filename):
+        """
+        Returns the (AnalysisLoader, lock) for off_filename. The loader is
+        marked in use, so that it is not evicted, until _release is called.
+        """
+        with self._lock:
+            entry = self._loaders.get(off_filename)
+            if entry is None:
+                entry = [AnalysisLoader(self.catalog), threading.Lock(), 0]
+                self._loaders[off_filename] = entry
+            else:
+                self._loaders.move_to_end(off_filename)
+            entry[2] += 1
+            self._evict()
+            return entry[0], entry[1]
+
+    def _release(self, off_filename):
+        with self._lock:
+            self._loaders[off_filename][2] -= 1
+            self._evict()
+
+    def _evict(self):
+        # Evict the least recently used loaders that are not in use
+        for key in list(self._loaders):
+            if len(self._loaders) <= self.max_loaders:
+                break
+            if self._loaders[key][2] == 0:
+                self._loaders.pop(key)[0].pool.close()
+
+    def _work(self):
+        while True:
+            with self._lock:
+                rerun = self._reruns.popleft() if self._reruns else None
+            if rerun is not None:
+                self._process(rerun)
+                continue
+            uid = self._queue.get()
+            try:
+                if uid is None:
+                    return
+                self._process(uid)
+            finally:
+                self._queue.task_done()
+
+    def _process(self, uid):
+        with self._lock:
+            doc, queued = self._pending.pop(uid)
+            self._running.add(uid)
+        start = time.monotonic()
+        try:
+            run = getRunFromStop(doc, self.catalog)
+            off_filename = get_filename(run)
+            loader, lock = self._loader(off_filename)
+            try:
+                with lock:
+                    process_run(run, self.catalog, loader, **self.kwargs)
+            finally:
+                self._release(off_filename)
+            self.processed += 1
+        except Exception:
+            self.failed += 1
+            print(f"Processing run {uid} failed")
+            traceback.print_exc()
+        finally:
+            end = time.monotonic()
+            with self._lock:
+                self._latency.append(end - queued)
+                self._duration.append(end - start)
+                self._running.discard(uid)
+                doc = self._rerun.pop(uid, None)
+                if doc is not None:
+                    self._pending[uid] = (doc, end)
+                    self._reruns.append(uid)
+                else:
+                    self._outstanding -= 1
+                    if not self._outstanding:
+                        self._idle.notify_all()
 
+    @property
+    def queue_depth(self):
+        return len(self._pending)
 
-def dispatch():
-    d = RemoteDispatcher('localhost:5578')
-    d.subscribe(getDocumentHandler())
+    def stats(self):
+        """
+        Returns a dictionary with the number of queued and running runs, the
+        number of processed, failed and coalesced requests, and the mean and
+        maximum latency (from stop document to finished processing) and
+        processing time of recent runs, in seconds
+        """
+        with self._lock:
+            latency = list(self._latency)
+            duration = list(self._duration)
+            stats = {
+                "queue_depth": len(self._pending),
+                "running": len(self._running),
+                "processed": self.processed,
+                "failed": self.failed,
+                "coalesced": self.coalesced,
+            }
+        for key, values in [("latency", latency), ("duration", duration)]:
+            stats[f"mean_{key}"] = sum(values) / len(values) if values else None
+            stats[f"max_{key}"] = max(values) if values else None
+        return stats
+
+
+class LocalDispatcher:
+    """
+    In-process stand-in for bluesky's RemoteDispatcher, which feeds
+    (name, doc) pairs from an iterable to the subscribed callbacks
+    """
+
+    def __init__(self, documents=()):
+        self.documents = documents
+        self._callbacks = []
+
+    def subscribe(self, callback):
+        self._callbacks.append(callback)
+
+    def emit(self, name, doc):
+        for callback in self._callbacks:
+            callback(name, doc)
+
+    def start(self):
+        for name, doc in self.documents:
+            self.emit(name, doc)
+
+
+def getDocumentHandler(catalog, workers=1, **kwargs):
+    """
+    Returns a started LiveProcessor for catalog
+    """
+    handler = LiveProcessor(catalog, workers=workers, **kwargs)
+    handler.start()
+    return handler
+
+
+def dispatch(catalog, address="localhost:5578", workers=1, dispatcher=None, **kwargs):
+    """
+    Process runs from catalog as their stop documents are published
+
+    address : 0MQ proxy to receive documents from
+    dispatcher : optional dispatcher to use instead of a RemoteDispatcher,
+                 e.g. a LocalDispatcher
+    """
+    if dispatcher is None:
+        from bluesky.callbacks.zmq import RemoteDispatcher
+
+        dispatcher = RemoteDispatcher(address)
+    handler = getDocumentHandler(catalog, workers=workers, **kwargs)
+    dispatcher.subscribe(handler)
     print("Ready for documents, starting handler")
-    d.start()
+    try:
+        dispatcher.start()
+    finally:
+        handler.stop()
+    return handler
 
 
 if __name__ == "__main__":
-    dispatch()
+    import argparse
+    from tiled.client import from_profile
+
+    parser = argparse.ArgumentParser(description="Process TES runs as they finish")
+    parser.add_argument("profile", help="tiled profile of the raw data catalog")
+    parser.add_argument("--address", default="localhost:5578")
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+    dispatch(from_profile(args.profile), args.address, args.workers)
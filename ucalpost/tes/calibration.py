@@ -1,12 +1,18 @@
 import mass
 from mass.calibration.algorithms import line_names_and_energies
 import os
+import hashlib
+import shutil
+import multiprocessing
 from os import path
 from itertools import combinations
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.gridspec import GridSpec
 import h5py
+from .energy import TabulatedCalibration, DEFAULT_KNOTS
 
 cal_line_master = {
     "ck": 278.21,
@@ -33,6 +39,27 @@ cal_line_master = {
 
 mass.line_models.VALIDATE_BIN_SIZE = False
 
+# Fixed binning of the filtValue histograms used for peak finding. The bins
+# are much narrower than the ph_fwhm used to smooth them. Unless an hmax is
+# given, the histograms start at CAL_HIST_MAX and grow to cover the data, up
+# to CAL_HIST_MAX_BINS bins.
+CAL_HIST_BINSIZE = 1.0
+CAL_HIST_MAX = 65536.0
+CAL_HIST_MAX_BINS = 2**18
+# Number of pulses read at a time while histogramming
+CAL_HIST_CHUNK = 2**20
+# Calibration point columns of the calibration file, and the
+# EnergyCalibration attribute each is read from
+CAL_POINT_COLUMNS = {
+    "ph": "_ph",
+    "energy": "_energies",
+    "dph": "_dph",
+    "de": "_de",
+    "name": "_names",
+}
+# Bump when a change to the calibration procedure invalidates cached results
+CAL_CACHE_VERSION = 1
+
 
 def get_line_energies(line_names):
     """
@@ -79,10 +106,15 @@ def assignPeaks(
     while True:
         sel_positions = np.asarray(peak_positions[:n_sel], dtype="float")
 
-        assign = getPeakCombinations(sel_positions, len(energies), autoinclude)
-        bestPeaks, bestRMS, allRMS = getAccuracyEstimates(
-            energies, assign, curvename, polyorder
-        )
+        if debug:
+            assign = getPeakCombinations(sel_positions, len(energies), autoinclude)
+            bestPeaks, bestRMS, allRMS = getAccuracyEstimates(
+                energies, assign, curvename, polyorder
+            )
+        else:
+            bestPeaks, bestRMS = getBestAssignment(
+                energies, sel_positions, autoinclude, curvename, polyorder
+            )
 
         if bestRMS > rms_cutoff:
             n_sel += nincrement
@@ -111,10 +143,7 @@ def getAccuracyEstimates(energies, assignments, curvename="gain", maxPolyOrder=5
     maxPolyOrder : The maximum order of polynomial to be used to fit the peaks
     """
     polyorder = min(len(energies) - 2, maxPolyOrder)
-    allRMS = []
-    for peaks in assignments[:, ...]:
-        _, _, rms = find_poly_residual(energies, peaks, polyorder, curvename)
-        allRMS.append(rms)
+    allRMS = find_poly_rms(energies, assignments, polyorder, curvename)
     bestRMSIndex = np.argmin(allRMS)
     bestRMS = allRMS[bestRMSIndex]
     bestPeaks = assignments[bestRMSIndex, :]
@@ -122,6 +151,97 @@ def getAccuracyEstimates(energies, assignments, curvename="gain", maxPolyOrder=5
     return bestPeaks, bestRMS, allRMS
 
 
+def getBestAssignment(
+    energies, positions, autoinclude=1, curvename="gain", maxPolyOrder=5
+):
+    """
+    Branch-and-bound search for the same assignment that getAccuracyEstimates
+    picks from getPeakCombinations, without enumerating every combination.
+
+    Peaks are assigned to energies in increasing order. The residual of a
+    least-squares fit can only grow as points are added, so the residual of
+    a partial assignment bounds every assignment that extends it, and
+    branches that are already worse than the best complete assignment are
+    pruned.
+
+    energies : Physical energies of peaks
+    positions : Candidate peak positions, tallest first
+    autoinclude : Number of tallest peaks to include in all assignments
+    curvename : input to find_poly_residual, assumed form of TES gain curve
+    maxPolyOrder : The maximum order of polynomial to be used to fit the peaks
+
+    Returns (bestPeaks, bestRMS). Raises ValueError if there are fewer
+    positions than energies, as getAccuracyEstimates does.
+    """
+    npeaks = len(energies)
+    if len(positions) < npeaks:
+        raise ValueError(f"Cannot assign {npeaks} energies to {len(positions)} peaks")
+    polyorder = min(npeaks - 2, maxPolyOrder)
+    required = np.zeros(len(positions), dtype=bool)
+    required[:autoinclude] = True
+    order = np.argsort(positions, kind="stable")
+    sorted_positions = np.asarray(positions, dtype="float")[order]
+    required = required[order]
+    # next_required[i] is the first required peak at or after i
+    next_required = np.full(len(positions) + 1, len(positions))
+    for i in range(len(positions) - 1, -1, -1):
+        next_required[i] = i if required[i] else next_required[i + 1]
+    nrequired_after = np.append(np.cumsum(required[::-1])[::-1], 0)
+
+    best = {"ssr": np.inf, "peaks": None}
+
+    def children_ssr(chosen, candidates):
+        """
+        Returns (bounds, scores) for extending chosen by each candidate.
+        Complete assignments always get their residual at polyorder. Until a
+        partial assignment has more points than polynomial coefficients the
+        bound is zero, and a lower order fit is used only to decide which
+        branch to visit first.
+        """
+        nfit = len(chosen) + 1
+        exact = nfit == npeaks or nfit > polyorder + 1
+        if nfit < 3 and not exact:
+            zeros = np.zeros(len(candidates))
+            return zeros, zeros
+        assignments = np.empty((len(candidates), nfit), dtype=int)
+        assignments[:, :-1] = chosen
+        assignments[:, -1] = candidates
+        degree = polyorder if exact else nfit - 2
+        ssr = _poly_ssr(
+            energies[:nfit], sorted_positions[assignments], degree, curvename
+        )
+        if exact:
+            return ssr, ssr
+        return np.zeros(len(candidates)), ssr
+
+    def search(chosen, start):
+        remaining = npeaks - len(chosen)
+        last = min(next_required[start], len(positions) - remaining)
+        candidates = [
+            i for i in range(start, last + 1) if nrequired_after[i + 1] <= remaining - 1
+        ]
+        if not candidates:
+            return
+        bounds, scores = children_ssr(chosen, candidates)
+        # Visiting the most promising branches first tightens the bound early
+        for n in np.argsort(scores, kind="stable"):
+            ssr = bounds[n]
+            i = candidates[n]
+            if ssr >= best["ssr"]:
+                continue
+            if remaining == 1:
+                best["ssr"] = ssr
+                best["peaks"] = sorted_positions[chosen + [i]]
+            else:
+                search(chosen + [i], i + 1)
+
+    search([], 0)
+    if best["peaks"] is None:
+        raise ValueError("No complete peak assignment")
+    bestRMS = np.sqrt(best["ssr"] / npeaks)
+    return best["peaks"], bestRMS
+
+
 def getPeakCombinations(positions, npeaks, autoinclude=1):
     peakCombos = []
     if autoinclude == npeaks:
@@ -136,18 +256,178 @@ def getPeakCombinations(positions, npeaks, autoinclude=1):
     return peakCombos
 
 
-def debugAssignment(ds, attr, states, ph_fwhm, line_names, assignment="nsls", **kwargs):
-    peak_ph_vals, _peak_heights = mass.algorithms.find_local_maxima(
-        ds.getAttr(attr, indsOrStates=states), ph_fwhm
-    )
+def state_slices(ds, states):
+    """
+    Returns the list of pulse slices covered by a state name, a list of
+    state names, or None for all pulses
+    """
+    if states is None:
+        return [slice(0, len(ds.offFile["unixnano"]))]
+    if isinstance(states, str):
+        states = [states]
+    slices = []
+    for state in states:
+        inds = ds.statesDict[state]
+        if isinstance(inds, slice):
+            slices.append(inds)
+        else:
+            slices.extend(inds)
+    return slices
 
 
-def ds_learnCalibrationPlanFromEnergiesAndPeaks(
-    self, attr, states, ph_fwhm, line_names, assignment="nsls", **kwargs
+def _pulse_ranges(ds, states):
+    ranges = []
+    for inds in state_slices(ds, states):
+        stop = inds.stop
+        if stop is None:
+            stop = len(ds.offFile["unixnano"])
+        ranges.append((inds.start or 0, stop))
+    return ranges
+
+
+def stream_histogram(
+    ds, attr, ranges, lo, binsize, nbins, chunksize=CAL_HIST_CHUNK, transform=None
 ):
-    peak_positions, _peak_heights = mass.algorithms.find_local_maxima(
-        self.getAttr(attr, indsOrStates=states), ph_fwhm
+    """
+    Histogram attr over the (start, stop) pulse ranges into nbins bins of
+    width binsize starting at lo, reading chunksize pulses at a time
+
+    transform : optional function applied to each chunk of values before
+                they are histogrammed
+    """
+    counts, _ = _stream_histogram(
+        ds, attr, ranges, lo, binsize, nbins, nbins, chunksize, transform
     )
+    return counts
+
+
+def _stream_histogram(
+    ds, attr, ranges, lo, binsize, nbins, max_nbins, chunksize, transform=None
+):
+    """
+    stream_histogram, with the number of bins doubled as needed to cover the
+    values, up to max_nbins bins
+
+    Returns counts, and the number of finite values above the last bin
+    """
+    counts = np.zeros(nbins, dtype=np.int32)
+    overflow = 0
+    for start, stop in ranges:
+        for i in range(start, stop, chunksize):
+            values = ds.getAttr(attr, slice(i, min(i + chunksize, stop)))
+            if transform is not None:
+                values = transform(values)
+            bins = np.floor((np.asarray(values) - lo) / binsize)
+            bins = bins[np.isfinite(bins) & (bins >= 0)]
+            size = len(counts)
+            if len(bins) > 0:
+                while bins.max() >= size and size < max_nbins:
+                    size = min(2 * size, max_nbins)
+            if size > len(counts):
+                counts = np.concatenate(
+                    [counts, np.zeros(size - len(counts), dtype=np.int32)]
+                )
+            inside = bins < len(counts)
+            overflow += len(bins) - int(np.count_nonzero(inside))
+            bins = bins[inside].astype(np.int64)
+            counts += np.bincount(bins, minlength=len(counts)).astype(np.int32)
+    return counts, overflow
+
+
+def ds_calibrationHistogram(
+    self,
+    attr,
+    states,
+    binsize=CAL_HIST_BINSIZE,
+    hmax=None,
+    chunksize=CAL_HIST_CHUNK,
+):
+    """
+    Histogram of attr over states in fixed bins of width binsize from 0 to
+    hmax. If hmax is None, the bins cover at least CAL_HIST_MAX and are
+    extended to the largest value of attr, up to CAL_HIST_MAX_BINS bins.
+    Pulses above the last bin are dropped, and their number is printed. The
+    pulses are read chunksize at a time, so only the counts are held in
+    memory. The counts are cached on the channel, and reused until the
+    states grow or the recipe for attr is replaced.
+
+    Returns counts, bin_edges
+    """
+    slices = _pulse_ranges(self, states)
+    recipe = self.recipes[attr] if attr in self.recipes.keys() else None
+    key = (attr, tuple(slices), binsize, hmax)
+    cached = getattr(self, "_calibrationHistogramCache", None)
+    if cached is not None and cached[0] == key and cached[1] is recipe:
+        counts = cached[2]
+    else:
+        if hmax is None:
+            nbins = int(np.ceil(CAL_HIST_MAX / binsize))
+            max_nbins = max(nbins, CAL_HIST_MAX_BINS)
+        else:
+            nbins = max_nbins = int(np.ceil(hmax / binsize))
+        counts, overflow = _stream_histogram(
+            self, attr, slices, 0, binsize, nbins, max_nbins, chunksize
+        )
+        if overflow:
+            print(
+                f"Chan {self.channum}: {overflow} pulses above "
+                f"{len(counts) * binsize} left out of the {attr} histogram"
+            )
+        self._calibrationHistogramCache = (key, recipe, counts)
+    return counts, np.arange(len(counts) + 1) * binsize
+
+
+mass.off.Channel.calibrationHistogram = ds_calibrationHistogram
+
+
+def find_local_maxima_hist(counts, bin_edges, gaussian_fwhm):
+    """
+    Equivalent of mass.algorithms.find_local_maxima for pulses that are
+    already histogrammed in evenly spaced bins. The histogram is smoothed by a
+    gaussian of gaussian_fwhm, and the local maxima are returned sorted by
+    height as (peak_locations, peak_intensities)
+    """
+    counts = np.asarray(counts, dtype=float)
+    binsize = bin_edges[1] - bin_edges[0]
+    occupied = np.flatnonzero(counts)
+    if len(occupied) == 0:
+        return np.array([]), np.array([])
+    # Pad by 3 fwhm on each side, as find_local_maxima does, so that the
+    # circular convolution does not wrap peaks around
+    pad = int(np.ceil(3 * gaussian_fwhm / binsize))
+    first = occupied[0] - pad
+    hist = counts[occupied[0] : occupied[-1] + 1]
+    n = len(hist) + 2 * pad
+    nfft = 2 ** int(np.ceil(np.log2(n)))
+    sigma = gaussian_fwhm / (np.sqrt(np.log(2) * 2) * 2)
+    tx = np.fft.rfftfreq(nfft, binsize)
+    ty = np.exp(-2 * (np.pi * sigma * tx) ** 2)
+    y = np.fft.irfft(np.fft.rfft(hist, nfft) * ty, nfft)
+    # rfft puts the data at the start of the buffer, shift the padding back
+    y = np.roll(y, pad)[:n]
+    x = bin_edges[0] + (np.arange(n) + first + 0.5) * binsize
+
+    flag = (y[1:-1] > y[:-2]) & (y[1:-1] > y[2:])
+    lm = np.arange(1, n - 1)[flag]
+    lm = lm[np.argsort(-y[lm])]
+    return x[lm], y[lm]
+
+
+def debugAssignment(ds, attr, states, ph_fwhm, line_names, assignment="nsls", **kwargs):
+    counts, bin_edges = ds.calibrationHistogram(attr, states)
+    peak_ph_vals, _peak_heights = find_local_maxima_hist(counts, bin_edges, ph_fwhm)
+
+
+def find_peaks_and_assign(
+    counts, bin_edges, ph_fwhm, line_names, assignment="nsls", **kwargs
+):
+    """
+    Find the peaks in a histogram and assign them to line_names. Only depends
+    on its arguments, so that it can be run in a worker process.
+
+    Returns name_or_e, e_out, assignment, rms
+    """
+    peak_positions, _peak_heights = find_local_maxima_hist(counts, bin_edges, ph_fwhm)
     if assignment == "nsls":
         name_or_e, e_out, assignment, rms = assignPeaks(
             peak_positions, line_names, **kwargs
@@ -157,7 +437,10 @@ def ds_learnCalibrationPlanFromEnergiesAndPeaks(
             peak_positions, line_names, maxacc=0.1, **kwargs
         )
         rms = None
+    return name_or_e, e_out, assignment, rms
 
+
+def ds_calibrationPlanFromAssignment(self, attr, states, name_or_e, assignment):
     self.calibrationPlanInit(attr)
     for ph, name in zip(assignment, name_or_e):
         if type(name) is str:
@@ -166,6 +449,32 @@ def ds_learnCalibrationPlanFromEnergiesAndPeaks(
             energy = name
             name = str(energy)
             self.calibrationPlanAddPoint(ph, name, states=states, energy=energy)
+
+
+mass.off.Channel.calibrationPlanFromAssignment = ds_calibrationPlanFromAssignment
+
+
+def ds_learnCalibrationPlanFromEnergiesAndPeaks(
+    self,
+    attr,
+    states,
+    ph_fwhm,
+    line_names,
+    assignment="nsls",
+    binsize=CAL_HIST_BINSIZE,
+    hmax=None,
+    **kwargs,
+):
+    counts, bin_edges = self.calibrationHistogram(attr, states, binsize, hmax)
+    name_or_e, e_out, assignment, rms = find_peaks_and_assign(
+        counts,
+        bin_edges,
+        ph_fwhm,
+        line_names,
+        assignment,
+        **kwargs,
+    )
+    self.calibrationPlanFromAssignment(attr, states, name_or_e, assignment)
     return e_out, assignment, rms
 
 
@@ -174,33 +483,181 @@ mass.off.Channel.learnCalibrationPlanFromEnergiesAndPeaks = (
 )
 
 
-def data_calibrationLoadFromHDF5Simple(self, h5name, recipeName="energy"):
-    print(f"loading calibration from {h5name}")
+def calibration_columns(cals):
+    """
+    Pack {channum: EnergyCalibration} into the columnar layout written by
+    calibrationSaveToHDF5Simple. The calibration points of all channels are
+    concatenated, and channel n owns points offsets[n]:offsets[n + 1].
+    """
+    channels = sorted(cals)
+    ordered = [cals[chan] for chan in channels]
+    npoints = [len(cal._ph) for cal in ordered]
+    columns = {
+        "channels": np.array(channels, dtype=np.int64),
+        "offsets": np.concatenate([[0], np.cumsum(npoints)]).astype(np.int64),
+        "nonlinearity": np.array([cal.nonlinearity for cal in ordered], dtype=float),
+        "curvetype": np.array(
+            [str(cal.CURVETYPE[cal._curvetype]).encode() for cal in ordered]
+        ),
+        "approximate": np.array(
+            [cal._use_approximation for cal in ordered], dtype=bool
+        ),
+    }
+    for column, attr in CAL_POINT_COLUMNS.items():
+        values = [np.asarray(getattr(cal, attr)) for cal in ordered]
+        if column == "name":
+            values = [[str(n).encode() for n in v] for v in values]
+            columns[column] = np.array(sum(values, []), dtype=bytes)
+        else:
+            columns[column] = np.concatenate([[]] + values).astype(float)
+    return columns
+
+
+def calibrations_from_columns(columns):
+    """
+    Inverse of calibration_columns, returns {channum: EnergyCalibration}
+    """
+    cals = {}
+    offsets = columns["offsets"]
+    names = [n.decode() for n in columns["name"]]
+    for n, chan in enumerate(columns["channels"]):
+        cal = mass.calibration.EnergyCalibration(
+            columns["nonlinearity"][n],
+            columns["curvetype"][n].decode(),
+            bool(columns["approximate"][n]),
+        )
+        points = slice(offsets[n], offsets[n + 1])
+        for ph, e, name, dph, de in zip(
+            columns["ph"][points],
+            columns["energy"][points],
+            names[points],
+            columns["dph"][points],
+            columns["de"][points],
+        ):
+            cal.add_cal_point(ph, e, name, dph, de)
+        cals[int(chan)] = cal
+    return cals
+
+
+def read_calibration_hdf5(h5name):
+    """
+    Read every channel calibration from a calibration file, in either the
+    columnar layout or the older layout with one group per channel
+
+    Returns calibrationAttr, {channum: EnergyCalibration}
+    """
     with h5py.File(h5name, "r") as h5:
-        nchans = len(list(h5.keys()))
-        print(f"Calibration for {nchans} channels found")
         calibrationAttr = h5.attrs.get("calAttr", "filtValue")
-        for channum_str in h5.keys():
-            cal = mass.calibration.EnergyCalibration.load_from_hdf5(h5, channum_str)
-            channum = int(channum_str)
-            if channum in self:
-                ds = self[channum]
-                ds.recipes.add(recipeName, cal, [calibrationAttr], overwrite=True)
+        if "offsets" in h5:
+            columns = {key: h5[key][()] for key in h5.keys()}
+            cals = calibrations_from_columns(columns)
+        else:
+            cals = {}
+            for channum_str in h5.keys():
+                cal = mass.calibration.EnergyCalibration.load_from_hdf5(h5, channum_str)
+                cals[int(channum_str)] = cal
+    return calibrationAttr, cals
+
+
+class CalibrationRegistry:
+    """
+    Process-wide LRU cache of parsed calibration files, keyed by path and
+    mtime, so that a cal file shared by every run in a noise block is only
+    read once
+    """
+
+    def __init__(self, max_files=4):
+        """
+        max_files : number of calibration files to keep
+        """
+        self.max_files = max_files
+        self._cache = OrderedDict()
+
+    def get(self, h5name):
+        """
+        Returns calibrationAttr, {channum: EnergyCalibration} for h5name,
+        reading the file only if it is new or has been rewritten
+        """
+        key = path.abspath(h5name)
+        st = os.stat(h5name)
+        mtime = (st.st_mtime_ns, st.st_size)
+        if key in self._cache and self._cache[key][0] == mtime:
+            self._cache.move_to_end(key)
+        else:
+            self._cache[key] = (mtime, read_calibration_hdf5(h5name))
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_files:
+                self._cache.popitem(last=False)
+        return self._cache[key][1]
+
+    def evict(self, h5name):
+        self._cache.pop(path.abspath(h5name), None)
+
+    def clear(self):
+        self._cache.clear()
+
+
+CALIBRATION_REGISTRY = CalibrationRegistry()
+
+
+def tabulate_calibration(cal_file, nknots=DEFAULT_KNOTS, registry=CALIBRATION_REGISTRY):
+    """
+    Returns a TabulatedCalibration of every channel in cal_file, with attr
+    set to the attribute the calibration applies to
+    """
+    if registry is None:
+        calibrationAttr, cals = read_calibration_hdf5(cal_file)
+    else:
+        calibrationAttr, cals = registry.get(cal_file)
+    return TabulatedCalibration.from_calibrations(cals, nknots, calibrationAttr)
+
+
+def data_calibrationApply(self, cals, calibrationAttr, recipeName="energy"):
+    """
+    Add the calibrations in {channum: EnergyCalibration} as recipeName, and
+    mark channels without one bad. The calibration objects are shared, not
+    copied.
+    """
+    for channum, cal in cals.items():
+        if channum in self:
+            ds = self[channum]
+            ds.recipes.add(recipeName, cal, [calibrationAttr], overwrite=True)
     # set other channels bad
     for ds in self.values():
         if recipeName not in ds.recipes.keys():
             ds.markBad("no loaded calibration")
 
 
+mass.off.ChannelGroup.calibrationApply = data_calibrationApply
+
+
+def data_calibrationLoadFromHDF5Simple(
+    self, h5name, recipeName="energy", registry=CALIBRATION_REGISTRY
+):
+    """
+    registry : CalibrationRegistry to read the file through, or None to
+               always read it from disk
+    """
+    print(f"loading calibration from {h5name}")
+    if registry is None:
+        calibrationAttr, cals = read_calibration_hdf5(h5name)
+    else:
+        calibrationAttr, cals = registry.get(h5name)
+    print(f"Calibration for {len(cals)} channels found")
+    self.calibrationApply(cals, calibrationAttr, recipeName)
+
+
 mass.off.ChannelGroup.calibrationLoadFromHDF5Simple = data_calibrationLoadFromHDF5Simple
 
 
 def data_calibrationSaveToHDF5Simple(self, h5name, recipeName="energy"):
     print(f"writing calibration to {h5name}")
+    cals = {}
+    for ds in self.values():
+        cals[ds.channum] = ds.recipes[recipeName].f
     with h5py.File(h5name, "w") as h5:
-        for ds in self.values():
-            cal = ds.recipes[recipeName].f
-            cal.save_to_hdf5(h5, f"{ds.channum}")
+        for key, value in calibration_columns(cals).items():
+            h5[key] = value
         h5.attrs["calAttr"] = ds.calibrationPlanAttr
 
 
@@ -227,6 +684,243 @@ def find_poly_residual(cal_energies, opt_assignment, degree, curvename="gain"):
     return coeff, residual, residual_rms
 
 
+def _poly_ssr(cal_energies, assignments, degree, curvename="gain"):
+    """
+    Sum of squared residuals of find_poly_residual for every row of
+    assignments, solved together as a stack of least-squares problems
+    """
+    assignments = np.atleast_2d(np.asarray(assignments, dtype=float))
+    cal_energies = np.asarray(cal_energies, dtype=float)
+    ncombos = assignments.shape[0]
+    if curvename == "gain":
+        x = assignments
+        y = assignments / cal_energies
+    elif curvename == "loglog":
+        y = np.log(assignments)
+        x = np.broadcast_to(np.log(cal_energies), assignments.shape)
+    elif curvename == "loggain":
+        x = assignments
+        y = np.log(assignments / cal_energies)
+    elif curvename == "linear":
+        x = np.insert(assignments, 0, 0.0, axis=1)
+        y = np.broadcast_to(np.insert(cal_energies, 0, 0.0), x.shape)
+    else:
+        raise ValueError(f"Unknown curvename {curvename}")
+    # Vandermonde matrices in np.polyfit order, with columns scaled to unit
+    # norm as np.polyfit does, for conditioning
+    vander = x[:, :, np.newaxis] ** np.arange(degree, -1, -1)
+    scale = np.sqrt(np.sum(np.square(vander), axis=1, keepdims=True))
+    scale[scale == 0] = 1
+    q, _ = np.linalg.qr(vander / scale)
+    # The residual is the part of y outside the column space of each matrix
+    qty = np.einsum("nij,ni->nj", q, y)
+    residual = y - np.einsum("nij,nj->ni", q, qty)
+    return np.sum(np.square(residual), axis=1).reshape(ncombos)
+
+
+def find_poly_rms(cal_energies, assignments, degree, curvename="gain"):
+    """
+    Vectorized version of find_poly_residual, returning the residual RMS
+    for every row of assignments
+
+    cal_energies : Physical energies of peaks
+    assignments : (n_combinations, n_peaks) array of peak positions
+    degree : polynomial degree
+    curvename : "gain", "loglog", "loggain" or "linear"
+    """
+    ssr = _poly_ssr(cal_energies, assignments, degree, curvename)
+    return np.sqrt(ssr / len(cal_energies))
+
+
+_CALIBRATE_GROUP = None
+
+
+def _calibrate_channel_forked(
+    channum, cal_state, line_energies, fv, assignment, recipeName, kwargs
+):
+    """
+    Learn the calibration plan of a channel of the inherited ChannelGroup and
+    fit its lines. Returns channum, the calibration as calibration_columns,
+    the reason it failed or None, and the assignment rms.
+    """
+    ds = _CALIBRATE_GROUP[channum]
+    try:
+        e_out, peaks, rms = ds.learnCalibrationPlanFromEnergiesAndPeaks(
+            attr=fv,
+            ph_fwhm=50,
+            states=cal_state,
+            line_names=line_energies,
+            assignment=assignment,
+            **kwargs,
+        )
+    except ValueError:
+        return channum, None, "Failed peak assignment", None
+    try:
+        ds.calibrateFollowingPlan(
+            fv, calibratedName=recipeName, dlo=7, dhi=7, overwriteRecipe=True
+        )
+    except Exception as e:
+        return channum, None, f"Failed calibrateFollowingPlan: {e}", rms
+    return channum, calibration_columns({channum: ds.recipes[recipeName].f}), None, rms
+
+
+def _parallel_calibrate(
+    data,
+    channels,
+    cal_state,
+    line_energies,
+    fv,
+    assignment,
+    rms_cutoff,
+    recipeName,
+    workers,
+    **kwargs,
+):
+    """
+    Calibrate channels in a forked process pool. Each worker reads the
+    histogram of a channel, assigns its peaks and fits its lines, and the
+    resulting calibrations are added to the channels in this process. At
+    most 2*workers channels are in flight, to bound the memory held by the
+    queue.
+    """
+    global _CALIBRATE_GROUP
+    kwargs = dict(kwargs, rms_cutoff=rms_cutoff)
+    channums = iter([ds.channum for ds in channels])
+    # The workers are forked, so that they inherit the open ChannelGroup
+    _CALIBRATE_GROUP = data
+    try:
+        ctx = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(workers, mp_context=ctx) as ex:
+            pending = set()
+            while True:
+                for channum in channums:
+                    pending.add(
+                        ex.submit(
+                            _calibrate_channel_forked,
+                            channum,
+                            cal_state,
+                            line_energies,
+                            fv,
+                            assignment,
+                            recipeName,
+                            kwargs,
+                        )
+                    )
+                    if len(pending) >= 2 * workers:
+                        break
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    channum, columns, reason, rms = future.result()
+                    ds = data[channum]
+                    if reason is not None:
+                        print(f"Chan {channum} {reason}")
+                        ds.markBad(reason)
+                        continue
+                    cal = calibrations_from_columns(columns)[channum]
+                    ds.calibrationPlanInit(fv)
+                    ds.recipes.add(recipeName, cal, [fv], overwrite=True)
+                    if rms is not None and rms < rms_cutoff:
+                        print(f"Calibrating {channum} succeeded with rms: {rms}")
+    finally:
+        _CALIBRATE_GROUP = None
+
+
+def calibration_cache_key(counts, bin_edges, params):
+    """
+    Hash of a channel's calibration histogram and the parameters that the
+    calibration depends on
+    """
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(counts).tobytes())
+    h.update(repr((len(bin_edges), bin_edges[0], bin_edges[1])).encode())
+    h.update(repr(sorted(params.items())).encode())
+    return h.hexdigest()
+
+
+def load_cached_calibrations(cache_file, keys):
+    """
+    cache_file : HDF5 file written by save_cached_calibrations
+    keys : iterable of cache keys
+
+    Returns {key: (cal, reason)} for the keys that are in the cache. cal is
+    None for channels that failed, with the reason they were marked bad.
+    """
+    cached = {}
+    if cache_file is None or not path.exists(cache_file):
+        return cached
+    with h5py.File(cache_file, "r") as h5:
+        for key in keys:
+            if key not in h5:
+                continue
+            if "bad" in h5[key].attrs:
+                cached[key] = (None, h5[key].attrs["bad"])
+            else:
+                cal = mass.calibration.EnergyCalibration.load_from_hdf5(h5, key)
+                cached[key] = (cal, None)
+    return cached
+
+
+def save_cached_calibrations(cache_file, entries, keep=None):
+    """
+    cache_file : HDF5 file to add the entries to
+    entries : {key: (cal, reason)}, as returned by load_cached_calibrations
+    keep : If not None, the keys of cache_file to keep besides entries. The
+           file is rewritten without any other keys, since HDF5 does not
+           reclaim the space of deleted groups.
+    """
+    if not entries and keep is None:
+        return
+    if not path.exists(path.dirname(cache_file)):
+        os.makedirs(path.dirname(cache_file))
+    if keep is None:
+        _write_cached_calibrations(cache_file, entries)
+        return
+    tmpfile = cache_file + ".tmp"
+    with h5py.File(tmpfile, "w") as new:
+        if path.exists(cache_file):
+            with h5py.File(cache_file, "r") as old:
+                for key in keep:
+                    if key in old and key not in entries:
+                        old.copy(old[key], new, key)
+    _write_cached_calibrations(tmpfile, entries)
+    os.replace(tmpfile, cache_file)
+
+
+def _write_cached_calibrations(cache_file, entries):
+    with h5py.File(cache_file, "a") as h5:
+        for key, (cal, reason) in entries.items():
+            if key in h5:
+                del h5[key]
+            if cal is None:
+                h5.create_group(key).attrs["bad"] = reason
+            else:
+                cal.save_to_hdf5(h5, key)
+
+
+def _calibrate_from_cache(channels, keys, cache_file, fv, recipeName):
+    """
+    Apply cached calibrations to channels, and return the channels that
+    still need to be calibrated
+    """
+    cached = load_cached_calibrations(cache_file, keys.values())
+    misses = []
+    for ds in channels:
+        key = keys[ds.channum]
+        if key not in cached:
+            misses.append(ds)
+            continue
+        cal, reason = cached[key]
+        if cal is None:
+            ds.markBad(reason)
+        else:
+            ds.calibrationPlanInit(fv)
+            ds.recipes.add(recipeName, cal, [fv], overwrite=True)
+    print(f"Reused {len(channels) - len(misses)} cached channel calibrations")
+    return misses
+
+
 def data_calibrate(
     self,
     cal_state,
@@ -235,36 +929,106 @@ def data_calibrate(
     rms_cutoff=0.2,
     assignment="nsls",
     recipeName="energy",
-    faildir=None,
+    failfile=None,
+    workers=None,
+    cache_file=None,
+    binsize=CAL_HIST_BINSIZE,
+    hmax=None,
     **kwargs,
 ):
+    """
+    Find peaks, assign them to line_names and calibrate every channel
+
+    failfile : If not None, the energy histograms of channels that fail the
+               calibration cuts are saved to this npz file, see
+               save_failure_diagnostics
+    workers : If not None, calibrate channels in this many forked processes,
+              from reading their histograms to fitting their lines
+    cache_file : If not None, an HDF5 file of channel calibrations keyed by
+                 calibration_cache_key. Channels whose histogram and
+                 parameters are in the cache are not recalibrated. The
+                 cache is rewritten with only the keys of this calibration.
+    binsize, hmax : binning of the fv histograms that peaks are found in,
+                    see Channel.calibrationHistogram
+    """
     self.setDefaultBinsize(0.2)
     # ds.plotHist(np.arange(0,30000,10), fv, states=None)
     line_energies = get_line_energies(line_names)
     # ds.diagnoseCalibration()
-    for ds in self.values():
-        try:
-            e_out, peaks, rms = ds.learnCalibrationPlanFromEnergiesAndPeaks(
-                attr=fv,
-                ph_fwhm=50,
-                states=cal_state,
-                line_names=line_energies,
-                assignment=assignment,
-                rms_cutoff=rms_cutoff,
-                **kwargs,
+    channels = list(self.values())
+    failures = {}
+    if cache_file is not None:
+        params = dict(
+            kwargs,
+            version=CAL_CACHE_VERSION,
+            fv=fv,
+            cal_state=cal_state,
+            line_energies=line_energies,
+            rms_cutoff=rms_cutoff,
+            assignment=assignment,
+        )
+        keys = {}
+        for ds in channels:
+            counts, bin_edges = ds.calibrationHistogram(fv, cal_state, binsize, hmax)
+            keys[ds.channum] = calibration_cache_key(counts, bin_edges, params)
+        channels = _calibrate_from_cache(channels, keys, cache_file, fv, recipeName)
+    if workers is None:
+        for ds in channels:
+            try:
+                e_out, peaks, rms = ds.learnCalibrationPlanFromEnergiesAndPeaks(
+                    attr=fv,
+                    ph_fwhm=50,
+                    states=cal_state,
+                    line_names=line_energies,
+                    assignment=assignment,
+                    rms_cutoff=rms_cutoff,
+                    binsize=binsize,
+                    hmax=hmax,
+                    **kwargs,
+                )
+                if rms < rms_cutoff:
+                    print(f"Calibrating {ds.channum} succeeded with rms: {rms}")
+            except ValueError:
+                print(f"Chan {ds.channum} failed peak assignment")
+                ds.markBad("Failed peak assignment")
+        # self.alignToReferenceChannel(ds, fv, np.arange(1000, 27000,  10))
+        if cache_file is None:
+            self.calibrateFollowingPlan(
+                fv, calibratedName=recipeName, dlo=7, dhi=7, overwriteRecipe=True
             )
-            if rms < rms_cutoff:
-                print(f"Calibrating {ds.channum} succeeded with rms: {rms}")
-        except ValueError:
-            print("Chan {ds.channum} failed peak assignment")
-            ds.markBad("Failed peak assignment")
-
-    # self.alignToReferenceChannel(ds, fv, np.arange(1000, 27000,  10))
-    self.calibrateFollowingPlan(
-        fv, calibratedName=recipeName, dlo=7, dhi=7, overwriteRecipe=True
-    )
-    for ds in self.values():
+        else:
+            for ds in channels:
+                if ds.markedBadBool:
+                    continue
+                try:
+                    ds.calibrateFollowingPlan(
+                        fv,
+                        calibratedName=recipeName,
+                        dlo=7,
+                        dhi=7,
+                        overwriteRecipe=True,
+                    )
+                except Exception as e:
+                    ds.markBad(f"Failed calibrateFollowingPlan: {e}")
+    else:
+        _parallel_calibrate(
+            self,
+            channels,
+            cal_state,
+            line_energies,
+            fv,
+            assignment,
+            rms_cutoff,
+            recipeName,
+            workers,
+            binsize=binsize,
+            hmax=hmax,
+            **kwargs,
+        )
+    for ds in channels:
         # ds.calibrateFollowingPlan(fv, overwriteRecipe=True, dlo=7, dhi=7)
+        if ds.markedBadBool:
+            continue
 
         ecal = ds.recipes[recipeName].f
         degree = min(len(ecal._ph) - 1, 2)
@@ -280,20 +1044,31 @@ def data_calibrate(
             msg = "Failed calibration with ph < 0"
             print(msg)
             ds.markBad(msg)
-            if faildir is not None:
-                summarize_failed_ds(
-                    ds, cal_state, line_names, line_energies, faildir, msg
-                )
+            if failfile is not None:
+                counts = _summary_counts(ds, cal_state, line_energies, recipeName)
+                failures[ds.channum] = (msg, counts)
             continue
         if rms > rms_cutoff:
             msg = f"Failed calibration cut with RMS: {rms}, cutoff: {rms_cutoff}"
             print(msg)
             ds.markBad(msg)
-            if faildir is not None:
-                summarize_failed_ds(
-                    ds, cal_state, line_names, line_energies, faildir, msg
-                )
+            if failfile is not None:
+                counts = _summary_counts(ds, cal_state, line_energies, recipeName)
+                failures[ds.channum] = (msg, counts)
             continue
+    if failfile is not None:
+        redone = [ds.channum for ds in channels]
+        save_failure_diagnostics(failfile, line_names, line_energies, failures, redone)
+    if cache_file is not None:
+        entries = {}
+        for ds in channels:
+            if ds.markedBadBool:
+                entries[keys[ds.channum]] = (None, ds.markedBadReason)
+            else:
+                entries[keys[ds.channum]] = (ds.recipes[recipeName].f, None)
+        # Only the keys of this calibration are kept, so that the cache does
+        # not grow as the histograms of a live run change
+        save_cached_calibrations(cache_file, entries, keep=set(keys.values()))
 
 
 mass.off.ChannelGroup.calibrate = data_calibrate
@@ -307,20 +1082,25 @@ def make_calibration(
     cal_file_name=None,
     **kwargs,
 ):
-    attr = "filtValueDC" if calinfo.driftCorrected else "filtValue"
+    attr = "filtValueDC" if calinfo.hasDriftCorrection else "filtValue"
 
     if cal_file_name is None:
         cal_file_name = calinfo.cal_file
 
     if should_make_new_calibration(cal_file_name, overwrite):
-        faildir = calinfo.savefile[:-4] + "_failures"
+        failfile = path.splitext(calinfo.savefile)[0] + "_failures.npz"
         calinfo.data.markAllGood()
+        if cal_file_name is not None:
+            cache_file = path.splitext(cal_file_name)[0] + "_cache.hdf5"
+        else:
+            cache_file = None
         calinfo.data.calibrate(
             calinfo.state,
             calinfo.line_names,
             fv=attr,
             rms_cutoff=rms_cutoff,
-            faildir=faildir,
+            failfile=failfile,
+            cache_file=cache_file,
             **kwargs,
         )
         calinfo._calibrated = True
@@ -345,6 +1125,7 @@ def save_calibration(calinfo, cal_file_name):
         if not path.exists(path.dirname(cal_file_name)):
             os.makedirs(path.dirname(cal_file_name))
         calinfo.data.calibrationSaveToHDF5Simple(cal_file_name)
+        CALIBRATION_REGISTRY.evict(cal_file_name)
         calinfo.cal_file = cal_file_name
 
 
@@ -352,7 +1133,13 @@ def load_calibration(rd, calinfo):
     rd.data.calibrationLoadFromHDF5Simple(calinfo.cal_file)
     rd.load_ds()
     rd._calibrated = True
-    rd._calmd = {"cal_state": calinfo.state, "cal_file": calinfo.cal_file}
+    # The mtime identifies the calibration, since the file is overwritten when
+    # it is redone
+    rd._calmd = {
+        "cal_state": calinfo.state,
+        "cal_file": calinfo.cal_file,
+        "cal_mtime": os.stat(calinfo.cal_file).st_mtime_ns,
+    }
 
 
 class CalFigure:
@@ -382,20 +1169,27 @@ class CalFigure:
             self.panel.axvline(energy)
         self.fig.suptitle(title)
 
-    def plot_ds_calibration(self, ds, state, legend=True):
+    def plot_ds_calibration(self, ds, state, legend=True, table=None):
+        """
+        table : optional TabulatedCalibration to compute the energies with,
+                instead of the channel's energy recipe
+        """
         bins = np.arange(
             np.min(self.line_energies) - 50, np.max(self.line_energies) + 50, 1
         )
         centers = 0.5 * (bins[1:] + bins[:-1])
-        energies = ds.getAttr("energy", state)
+        energies = _ds_energies(ds, state, table)
         counts, _ = np.histogram(energies, bins)
+        self.plot_counts(centers, counts, f"Chan {ds.channum}", legend)
+
+    def plot_counts(self, centers, counts, label, legend=True):
         max_ylim = 0
         for ax in self.axlist:
-            ax.plot(centers, counts, label=f"Chan {ds.channum}")
+            ax.plot(centers, counts, label=label)
             max_ylim = max(max_ylim, ax.get_ylim()[1])
         for ax in self.axlist:
             ax.set_ylim(0, max_ylim)
-        self.panel.plot(centers, counts, label=f"Chan {ds.channum}")
+        self.panel.plot(centers, counts, label=label)
         if legend:
             self.panel.legend()
 
@@ -446,10 +1240,16 @@ def _make_single_figure(
     return fig, axlist
 
 
-def plot_ds_calibration(ds, state, line_energies, axlist, legend=True):
+def _ds_energies(ds, state, table=None):
+    if table is None:
+        return ds.getAttr("energy", state)
+    return table.channel(ds.channum, ds.getAttr(table.attr, state))
+
+
+def plot_ds_calibration(ds, state, line_energies, axlist, legend=True, table=None):
     bins = np.arange(np.min(line_energies) - 50, np.max(line_energies) + 50, 1)
     centers = 0.5 * (bins[1:] + bins[:-1])
-    energies = ds.getAttr("energy", state)
+    energies = _ds_energies(ds, state, table)
     counts, _ = np.histogram(energies, bins)
 
     for ax in axlist:
@@ -458,6 +1258,92 @@ def plot_ds_calibration(ds, state, line_energies, axlist, legend=True):
         ax.legend()
 
 
+def save_failure_diagnostics(failfile, line_names, line_energies, failures, redone=()):
+    """
+    Record failed channels as data instead of figures, so that they can be
+    plotted later with render_failure_diagnostics
+
+    failfile : npz file with one entry per failed channel
+    failures : {channum: (reason, counts)}, with counts histogrammed as in
+               summary_histograms
+    redone : Channels that were recalibrated. Failures from an existing
+             failfile are kept for the other channels.
+    """
+    failures = dict(failures)
+    if path.exists(failfile):
+        old = load_failure_diagnostics(failfile)
+        if np.array_equal(old["line_energies"], line_energies):
+            for chan, reason, counts in zip(
+                old["channels"], old["reasons"], old["counts"]
+            ):
+                if chan not in redone and chan not in failures:
+                    failures[int(chan)] = (str(reason), counts)
+    if not failures:
+        if path.exists(failfile):
+            os.remove(failfile)
+        return
+    if not path.exists(path.dirname(failfile)):
+        os.makedirs(path.dirname(failfile))
+    channels = sorted(failures)
+    np.savez(
+        failfile,
+        channels=np.array(channels, dtype=int),
+        reasons=np.array([failures[chan][0] for chan in channels], dtype=str),
+        counts=np.array([failures[chan][1] for chan in channels]),
+        centers=_summary_centers(line_energies),
+        line_names=np.array([str(name) for name in line_names]),
+        line_energies=np.asarray(line_energies, dtype=float),
+    )
+    print(f"Saved diagnostics for {len(channels)} failed channels to {failfile}")
+
+
+def load_failure_diagnostics(failfile):
+    with np.load(failfile) as f:
+        return {key: f[key] for key in f.files}
+
+
+def render_failure_diagnostics(failfile, savedir=None, channels=None, workers=None):
+    """
+    Plot the failures recorded by save_failure_diagnostics, one figure per
+    channel, into savedir and a copy of it in the current directory
+
+    savedir : Defaults to failfile without its extension
+    channels : If not None, only plot these channels
+    workers : If not None, render the figures in this many processes
+    """
+    if savedir is None:
+        savedir = path.splitext(failfile)[0]
+    curdir = path.basename(savedir)
+    for d in [savedir, curdir]:
+        if not path.exists(d):
+            os.makedirs(d)
+    failures = load_failure_diagnostics(failfile)
+    line_names = list(failures["line_names"])
+    line_energies = list(failures["line_energies"])
+    tasks = []
+    for chan, reason, counts in zip(
+        failures["channels"], failures["reasons"], failures["counts"]
+    ):
+        if channels is not None and chan not in channels:
+            continue
+        filename = f"cal_{chan}_failure.png"
+        tasks.append(
+            dict(
+                savenames=[
+                    os.path.join(savedir, filename),
+                    os.path.join(curdir, filename),
+                ],
+                line_names=line_names,
+                line_energies=line_energies,
+                centers=failures["centers"],
+                counts=[counts],
+                labels=[f"Chan {chan}"],
+                title=f"{chan}: {reason}",
+            )
+        )
+    render_summary_pages(tasks, workers)
+
+
 def summarize_failed_ds(ds, state, line_names, line_energies, savedir, reason=""):
     fig = CalFigure(line_names, line_energies, title=f"{ds.channum}: {reason}")
     fig.plot_ds_calibration(ds, state)
@@ -474,21 +1360,194 @@ def summarize_failed_ds(ds, state, line_names, line_energies, savedir, reason=""
     fig.save(curname)
 
 
-def summarize_calibration(calinfo, overwrite=False):
+def summary_histograms(data, state, line_energies, table=None):
+    """
+    Energy histograms around the calibration lines for every channel, in the
+    1 eV bins used by CalFigure
+
+    table : optional TabulatedCalibration to compute the energies with,
+            instead of each channel's energy recipe
+
+    Returns channels, centers, counts with counts of shape
+    (len(channels), len(centers))
+    """
+    channels = list(data)
+    centers = _summary_centers(line_energies)
+    counts = np.zeros((len(channels), len(centers)), dtype=np.int32)
+    for n, chan in enumerate(channels):
+        counts[n] = _summary_counts(data[chan], state, line_energies, table=table)
+    return channels, centers, counts
+
+
+def _summary_centers(line_energies):
+    bins = np.arange(np.min(line_energies) - 50, np.max(line_energies) + 50, 1)
+    return 0.5 * (bins[1:] + bins[:-1])
+
+
+def _summary_counts(ds, state, line_energies, attr="energy", table=None):
+    centers = _summary_centers(line_energies)
+    ranges = _pulse_ranges(ds, state)
+    if table is not None:
+        return stream_histogram(
+            ds,
+            table.attr,
+            ranges,
+            centers[0] - 0.5,
+            1,
+            len(centers),
+            transform=lambda values: table.channel(ds.channum, values),
+        )
+    return stream_histogram(ds, attr, ranges, centers[0] - 0.5, 1, len(centers))
+
+
+def _summary_pages(channels, nstack=8):
+    """
+    Group channels into pages of nstack channel numbers, returning a list of
+    (filename, indices into channels)
+    """
+    pages = []
+    startchan = 1
+    indices = []
+    for n, chan in enumerate(channels):
+        if chan > startchan + nstack - 1:
+            pages.append((f"cal_{startchan}_to_{startchan + nstack - 1}.png", indices))
+            indices = []
+            startchan = startchan + nstack
+        indices.append(n)
+        lastchan = chan
+    if channels:
+        pages.append((f"cal_{startchan}_to_{lastchan}.png", indices))
+    return pages
+
+
+def _link_or_copy(src, dst):
+    if path.abspath(src) == path.abspath(dst):
+        return
+    if path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _init_render_worker():
+    plt.switch_backend("Agg")
+
+
+def render_summary_page(
+    savenames,
+    line_names,
+    line_energies,
+    centers,
+    counts,
+    labels,
+    figsize=None,
+    title="Stacked calibration",
+    legend=True,
+):
+    """
+    Draw one CalFigure from precomputed histograms. The figure is saved to
+    the first of savenames, and the others are hardlinked (or copied) to it.
+    Only depends on its arguments, so that it can be run in a worker process.
+    """
+    fig = CalFigure(line_names, line_energies, figsize=figsize, title=title)
+    for c, label in zip(counts, labels):
+        fig.plot_counts(centers, c, label, legend)
+    fig.save(savenames[0])
+    for savename in savenames[1:]:
+        _link_or_copy(savenames[0], savename)
+
+
+def summarize_calibration(
+    calinfo, overwrite=False, workers=None, legacy=False, tabulated=False
+):
     """
     Should try to produce an overall summary
     Also, splitting into panels sometimes makes it hard to figure out if we
     are globally misaligned
 
     Now saves summaries into current directory as well as save directory
+
+    workers : If not None, render the figures in this many processes
+    legacy : If True, draw every channel directly from its energies and save
+             each figure twice, as was done originally
+    tabulated : If True, and not legacy, the energies of every channel are
+                evaluated from a TabulatedCalibration of calinfo.cal_file
+                instead of its energy recipe. This is faster, but only
+                approximates the calibration between the table's knots.
     """
-    savedir = calinfo.savefile[:-4] + "_summary"
+    savedir = path.splitext(calinfo.savefile)[0] + "_summary"
     curdir = path.basename(savedir)
     print(f"Saving summaries to {savedir}")
     if not path.exists(savedir):
         os.makedirs(savedir)
     if not path.exists(curdir):
         os.makedirs(curdir)
+    if legacy:
+        _summarize_calibration_legacy(calinfo, savedir, curdir, overwrite)
+        return
+    table = None
+    if tabulated:
+        table = tabulate_calibration(calinfo.cal_file)
+    line_names = calinfo.line_names
+    line_energies = get_line_energies(line_names)
+    naxes = len(line_names)
+    channels, centers, counts = summary_histograms(
+        calinfo.data, calinfo.state, line_energies, table
+    )
+    labels = [f"Chan {chan}" for chan in channels]
+    filename = "cal_summary_all_chan.png"
+    tasks = [
+        dict(
+            savenames=[os.path.join(savedir, filename), os.path.join(curdir, filename)],
+            line_names=line_names,
+            line_energies=line_energies,
+            centers=centers,
+            counts=counts,
+            labels=labels,
+            figsize=(3 * naxes, 6),
+            title="All ds calibration stacked",
+            legend=False,
+        )
+    ]
+    for filename, indices in _summary_pages(channels):
+        savenames = [os.path.join(savedir, filename), os.path.join(curdir, filename)]
+        savenames = [s for s in savenames if overwrite or not os.path.exists(s)]
+        if not savenames:
+            continue
+        tasks.append(
+            dict(
+                savenames=savenames,
+                line_names=line_names,
+                line_energies=line_energies,
+                centers=centers,
+                counts=counts[indices],
+                labels=[labels[i] for i in indices],
+            )
+        )
+    render_summary_pages(tasks, workers)
+
+
+def render_summary_pages(tasks, workers=None):
+    """
+    Call render_summary_page for each dictionary of arguments in tasks,
+    in a spawned process pool of this many workers if workers is not None
+    """
+    if workers is None:
+        for task in tasks:
+            render_summary_page(**task)
+    else:
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            workers, mp_context=ctx, initializer=_init_render_worker
+        ) as ex:
+            futures = [ex.submit(render_summary_page, **task) for task in tasks]
+            for future in futures:
+                future.result()
+
+
+def _summarize_calibration_legacy(calinfo, savedir, curdir, overwrite=False):
     line_names = calinfo.line_names
     line_energies = get_line_energies(line_names)
     nstack = 8
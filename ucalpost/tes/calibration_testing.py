@@ -41,7 +41,7 @@ def test_calibration(calinfo, rms_cutoff=0.2, **kwargs):
     """
     Calibrates data without saving anything.
     """
-    attr = "filtValueDC" if calinfo.driftCorrected else "filtValue"
+    attr = "filtValueDC" if calinfo.hasDriftCorrection else "filtValue"
 
     calinfo.data.calibrate(
         calinfo.state, calinfo.line_names, fv=attr, rms_cutoff=rms_cutoff, **kwargs
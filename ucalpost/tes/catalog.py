@@ -10,7 +10,7 @@ from ucalpost.databroker.run import (
     get_save_directory,
 )
 from ucalpost.tes.loader import get_analyzed_filename
-import numpy as np
+from ucalpost.tes.process_classes import save_processed_streams
 
 """
 Unfinished concept for a process catalog object that would replace loader/RawData/CalInfo
@@ -65,9 +65,7 @@ class CatalogData:
             print(f"Not overwriting {savefile}")
             return
 
-        timestamps = []
-        energies = []
-        channels = []
+        streams = []
         for ds in self.data.values():
             try:
                 uns, es = ds.getAttr(["unixnano", attr], state)
@@ -75,21 +73,9 @@ class CatalogData:
                 print(f"{ds.channum} failed")
                 ds.markBad("Failed to get energy")
                 continue
-            ch = np.zeros_like(uns) + ds.channum
-            timestamps.append(uns)
-            energies.append(es)
-            channels.append(ch)
-        ts_arr = np.concatenate(timestamps)
-        en_arr = np.concatenate(energies)
-        ch_arr = np.concatenate(channels)
-        sort_idx = np.argsort(ts_arr)
+            streams.append((uns, es, ds.channum))
         print(f"Saving {savefile}")
-        np.savez(
-            savefile,
-            timestamps=ts_arr[sort_idx],
-            energies=en_arr[sort_idx],
-            channels=ch_arr[sort_idx],
-        )
+        save_processed_streams(savefile, streams)
         # md = rd.getProcessMd()
         # with open(metafile, 'w') as f:
         #    yaml.dump(md, f)
@@ -0,0 +1,318 @@
+import mass
+import numpy as np
+from scipy.optimize import brent
+
+"""
+Drift correction that is updated as new pulses arrive, instead of relearned
+from every pulse of the file. This is opt-in, see process.drift_correct;
+by default mass's learnDriftCorrection is used once per file.
+
+Updating the correction changes filtValueDC under a calibration that was
+fit to it. The correction of each channel can be snapshotted when a
+calibration is made, and compared with the current one to decide when the
+calibration has to be redone.
+"""
+
+DC_INDICATOR_BINS = 16
+DC_VALUE_BINS = 8192
+DC_INDICATOR_MARGIN = 0.5
+DC_SMOOTH_BINS = 1.0
+DC_STALENESS_LIMIT = 0.02
+# Largest change in drift correction gain, over the indicator range of the
+# data, that a calibration made before the change is still used for
+DC_GAIN_TOLERANCE = 1e-4
+
+
+def _smoothed_histogram(values, weights, nbins, binsize, sigma_bins):
+    """
+    Histogram of weighted values from 0 to nbins*binsize, with each weight
+    split linearly between the two nearest bins, smoothed by a Gaussian of
+    width sigma_bins
+    """
+    pos = values / binsize - 0.5
+    i0 = np.floor(pos)
+    frac = pos - i0
+    ok = (i0 >= 0) & (i0 < nbins - 1)
+    i0 = i0[ok].astype(np.int64)
+    frac = frac[ok]
+    weights = weights[ok]
+    h = np.bincount(i0, weights * (1 - frac), minlength=nbins)
+    h += np.bincount(i0 + 1, weights * frac, minlength=nbins)
+    freq = np.fft.rfftfreq(nbins)
+    kernel = np.exp(-2 * (np.pi * freq * sigma_bins) ** 2)
+    h = np.fft.irfft(np.fft.rfft(h) * kernel, nbins)
+    h[h < 0] = 0
+    return h
+
+
+class DriftTracker:
+    def __init__(
+        self,
+        indicatorName="pretriggerMean",
+        uncorrectedName="filtValue",
+        indicator_bins=DC_INDICATOR_BINS,
+        value_bins=DC_VALUE_BINS,
+    ):
+        """
+        Drift correction of one channel, with the same gain model as
+        mass's DriftCorrection, gain = 1 + slope*(indicator - medianIndicator)
+
+        The slope minimizes the entropy of the corrected spectrum, as in
+        mass, but is found from a 2D histogram of indicator and uncorrected
+        value, with the mean indicator of each bin, rather than from the
+        pulses themselves. New pulses are added to the histogram, so
+        updating the slope costs O(new pulses) plus a fit whose cost does
+        not grow with the number of pulses.
+
+        The histogram bins are fixed when the correction is learned. Pulses
+        whose indicator falls outside of them cannot be added, and the
+        fraction of such pulses is the staleness of the correction.
+        """
+        self.indicatorName = indicatorName
+        self.uncorrectedName = uncorrectedName
+        self.indicator_bins = indicator_bins
+        self.value_bins = value_bins
+        self.medianIndicator = 0.0
+        self.slope = 0.0
+        self.counts = None
+        self.indicator_sums = None
+        self.npulses = 0
+        self.total = 0
+        self.overflow = 0
+
+    def apply(self, indicator, uncorrected):
+        gain = 1 + (indicator - self.medianIndicator) * self.slope
+        return gain * uncorrected
+
+    def snapshot(self):
+        """
+        The current correction, as (medianIndicator, slope, indicator range)
+        """
+        lo = self.medianIndicator + self.indicator_lo
+        hi = lo + self.indicator_bins * self.indicator_step
+        return (self.medianIndicator, self.slope, float(lo), float(hi))
+
+    def gain_change(self, snapshot):
+        """
+        Largest difference between the current gain and the gain of a
+        snapshot, over the snapshot's indicator range
+        """
+        median, slope, lo, hi = snapshot
+        x = np.array([lo, hi])
+        old = (x - median) * slope
+        new = (x - self.medianIndicator) * self.slope
+        return float(np.max(np.abs(new - old)))
+
+    @property
+    def staleness(self):
+        """
+        Fraction of the pulses since the correction was learned whose
+        indicator was outside of the histogram
+        """
+        if self.total == 0:
+            return 0.0
+        return self.overflow / self.total
+
+    def learn(self, indicator, uncorrected):
+        """
+        Set the histogram bins from indicator and uncorrected, and learn the
+        slope from them, discarding previously added pulses
+        """
+        indicator = np.asarray(indicator, dtype=float)
+        uncorrected = np.asarray(uncorrected, dtype=float)
+        self.medianIndicator = float(np.median(indicator))
+        lo, hi = np.percentile(indicator - self.medianIndicator, [0.5, 99.5])
+        span = max(hi - lo, 1e-6)
+        self.indicator_lo = lo - DC_INDICATOR_MARGIN * span
+        self.indicator_step = (1 + 2 * DC_INDICATOR_MARGIN) * span / self.indicator_bins
+        # Same range as the entropy histogram of mass's drift_correct
+        self.value_step = 1.25 * np.percentile(uncorrected, 99) / self.value_bins
+        shape = (self.indicator_bins, self.value_bins)
+        self.counts = np.zeros(shape, dtype=np.uint32)
+        self.indicator_sums = np.zeros(shape)
+        self.total = 0
+        self.overflow = 0
+        self._accumulate(indicator, uncorrected)
+        self.slope = self._fit((0, 0.001))
+
+    def update(self, indicator, uncorrected):
+        """
+        Add new pulses and refit the slope, starting from the current one
+        """
+        self._accumulate(
+            np.asarray(indicator, dtype=float), np.asarray(uncorrected, dtype=float)
+        )
+        self.slope = self._fit((self.slope, self.slope + 0.0001))
+
+    def _accumulate(self, indicator, uncorrected):
+        i = np.floor(
+            (indicator - self.medianIndicator - self.indicator_lo) / self.indicator_step
+        )
+        j = np.floor(uncorrected / self.value_step)
+        inside = (i >= 0) & (i < self.indicator_bins)
+        keep = inside & (j >= 0) & (j < self.value_bins)
+        flat = i[keep].astype(np.int64) * self.value_bins + j[keep].astype(np.int64)
+        counts = np.bincount(flat, minlength=self.counts.size)
+        sums = np.bincount(
+            flat, indicator[keep] - self.medianIndicator, minlength=self.counts.size
+        )
+        self.counts += counts.reshape(self.counts.shape).astype(np.uint32)
+        self.indicator_sums += sums.reshape(self.counts.shape)
+        self.total += len(indicator)
+        self.overflow += int(np.count_nonzero(~inside))
+
+    def _fit(self, bracket):
+        i, j = np.nonzero(self.counts)
+        if len(i) == 0:
+            return 0.0
+        weights = self.counts[i, j].astype(float)
+        x = self.indicator_sums[i, j] / weights
+        u = (j + 0.5) * self.value_step
+        ux = u * x
+
+        def entropy(slope):
+            h = _smoothed_histogram(
+                u + slope * ux,
+                weights,
+                self.value_bins,
+                self.value_step,
+                DC_SMOOTH_BINS,
+            )
+            h = h[h > 0]
+            return -(np.log(h) * h).sum()
+
+        return float(brent(entropy, brack=bracket))
+
+
+def ds_updateDriftCorrection(
+    self,
+    indicatorName="pretriggerMean",
+    uncorrectedName="filtValue",
+    correctedName=None,
+    staleness_limit=DC_STALENESS_LIMIT,
+):
+    """
+    Learn a DriftTracker for the channel, or update it with the pulses that
+    arrived since it was last updated. It is relearned from every pulse when
+    its staleness exceeds staleness_limit. The tracker is added as the
+    correctedName recipe, by default uncorrectedName + "DC", and is updated
+    in place, so recipes built on it follow the updated slope.
+
+    Returns the DriftTracker
+    """
+    if correctedName is None:
+        correctedName = uncorrectedName + "DC"
+    tracker = getattr(self, "_driftTracker", None)
+    if (
+        tracker is None
+        or tracker.indicatorName != indicatorName
+        or tracker.uncorrectedName != uncorrectedName
+    ):
+        tracker = DriftTracker(indicatorName, uncorrectedName)
+        self._driftTracker = tracker
+        self.recipes.add(
+            correctedName,
+            tracker.apply,
+            [indicatorName, uncorrectedName],
+            overwrite=True,
+        )
+    npulses = len(self.offFile["unixnano"])
+    if tracker.counts is not None and npulses == tracker.npulses:
+        return tracker
+    if tracker.counts is not None:
+        indicator, uncorrected = self.getAttr(
+            [indicatorName, uncorrectedName], slice(tracker.npulses, npulses)
+        )
+        tracker.update(indicator, uncorrected)
+    if tracker.counts is None or tracker.staleness > staleness_limit:
+        indicator, uncorrected = self.getAttr(
+            [indicatorName, uncorrectedName], slice(0, npulses)
+        )
+        tracker.learn(indicator, uncorrected)
+    tracker.npulses = npulses
+    # Cached calibration histograms of the corrected values are out of date
+    self._calibrationHistogramCache = None
+    return tracker
+
+
+mass.off.Channel.updateDriftCorrection = ds_updateDriftCorrection
+
+
+def ds_driftCorrectionCurrent(self):
+    """
+    True if the channel has a DriftTracker that includes all of its pulses
+    """
+    tracker = getattr(self, "_driftTracker", None)
+    if tracker is None or tracker.counts is None:
+        return False
+    return tracker.npulses == len(self.offFile["unixnano"])
+
+
+mass.off.Channel.driftCorrectionCurrent = ds_driftCorrectionCurrent
+
+
+def data_updateDriftCorrection(self, staleness_limit=DC_STALENESS_LIMIT, **kwargs):
+    """
+    Update the drift correction of every good channel, see
+    Channel.updateDriftCorrection. Channels that fail are marked bad.
+
+    Returns {channum: staleness}
+    """
+    staleness = {}
+    for ds in self.values():
+        try:
+            tracker = ds.updateDriftCorrection(
+                staleness_limit=staleness_limit, **kwargs
+            )
+        except Exception as e:
+            print(f"{ds.channum} drift correction failed")
+            ds.markBad(f"Failed drift correction: {e!r}")
+            continue
+        staleness[ds.channum] = tracker.staleness
+    return staleness
+
+
+mass.off.ChannelGroup.updateDriftCorrection = data_updateDriftCorrection
+
+
+def data_driftCorrectionCurrent(self):
+    """
+    True if every good channel's drift correction includes all of its pulses
+    """
+    return all(ds.driftCorrectionCurrent() for ds in self.values())
+
+
+mass.off.ChannelGroup.driftCorrectionCurrent = data_driftCorrectionCurrent
+
+
+def data_driftSnapshot(self):
+    """
+    Returns {channum: snapshot} of the channels with a DriftTracker, see
+    DriftTracker.snapshot
+    """
+    snapshot = {}
+    for ds in self.values():
+        tracker = getattr(ds, "_driftTracker", None)
+        if tracker is not None and tracker.counts is not None:
+            snapshot[ds.channum] = tracker.snapshot()
+    return snapshot
+
+
+mass.off.ChannelGroup.driftSnapshot = data_driftSnapshot
+
+
+def data_driftCorrectionChange(self, snapshot):
+    """
+    Largest gain change of any good channel since snapshot was taken with
+    driftSnapshot. Channels that were not in the snapshot are ignored.
+    """
+    change = 0.0
+    for ds in self.values():
+        tracker = getattr(ds, "_driftTracker", None)
+        if tracker is None or ds.channum not in snapshot:
+            continue
+        change = max(change, tracker.gain_change(snapshot[ds.channum]))
+    return change
+
+
+mass.off.ChannelGroup.driftCorrectionChange = data_driftCorrectionChange
@@ -0,0 +1,132 @@
+import numpy as np
+from os.path import join
+from .process_classes import (
+    PROCESSED_COLUMNS,
+    FILTVALUE_COLUMN,
+    TIME_INDEX_FILE,
+    TIME_INDEX_BLOCK,
+    load_time_index,
+    make_time_index,
+)
+
+"""
+Vectorized evaluation of the energy calibration of every channel at once
+"""
+
+DEFAULT_KNOTS = 4096
+
+
+class TabulatedCalibration:
+    def __init__(self, channels, lo, step, table, attr=None):
+        """
+        channels : sorted channel numbers
+        lo : filtValue of the first knot of each channel
+        step : knot spacing of each channel
+        table : (len(channels), nknots) array of energies at the knots
+        attr : optional name of the calibrated attribute, e.g. "filtValueDC"
+
+        Energies are interpolated linearly between knots, and extrapolated
+        from the first and last segments outside of them.
+        """
+        self.channels = np.asarray(channels)
+        self.lo = np.asarray(lo, dtype=float)
+        self.step = np.asarray(step, dtype=float)
+        self.table = np.asarray(table, dtype=float)
+        self.attr = attr
+
+    @classmethod
+    def from_calibrations(cls, cals, nknots=DEFAULT_KNOTS, attr=None):
+        """
+        Tabulate {channum: EnergyCalibration} on nknots evenly spaced
+        filtValues per channel, from a tenth of the lowest calibration point
+        to twice the highest. attr is the attribute the calibrations apply to.
+        """
+        channels = np.array(sorted(cals), dtype=np.int64)
+        lo = np.zeros(len(channels))
+        step = np.ones(len(channels))
+        table = np.zeros((len(channels), nknots))
+        for n, chan in enumerate(channels):
+            cal = cals[chan]
+            ph = np.asarray(cal._ph, dtype=float)
+            knots = np.linspace(0.1 * np.min(ph), 2 * np.max(ph), nknots)
+            lo[n] = knots[0]
+            step[n] = knots[1] - knots[0]
+            table[n] = cal.ph2energy(knots)
+        return cls(channels, lo, step, table, attr)
+
+    @property
+    def nknots(self):
+        return self.table.shape[1]
+
+    def __call__(self, channels, values):
+        """
+        Energies of photons with the given channel numbers and filtValues.
+        Photons from channels without a calibration get NaN.
+        """
+        channels = np.asarray(channels)
+        values = np.asarray(values, dtype=float)
+        row = np.searchsorted(self.channels, channels)
+        row = np.minimum(row, len(self.channels) - 1)
+        known = self.channels[row] == channels
+        t = (values - self.lo[row]) / self.step[row]
+        i = np.clip(np.floor(t).astype(np.int64), 0, self.nknots - 2)
+        e0 = self.table[row, i]
+        e1 = self.table[row, i + 1]
+        energies = e0 + (e1 - e0) * (t - i)
+        energies[~known] = np.nan
+        return energies
+
+    def channel(self, channum, values):
+        """
+        Energies of filtValues from a single channel
+        """
+        values = np.asarray(values)
+        return self(np.full(values.shape, channum), values)
+
+    def save(self, filename):
+        np.savez(
+            filename,
+            channels=self.channels,
+            lo=self.lo,
+            step=self.step,
+            table=self.table,
+            attr="" if self.attr is None else self.attr,
+        )
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as f:
+            attr = str(f["attr"]) if "attr" in f.files else ""
+            return cls(f["channels"], f["lo"], f["step"], f["table"], attr or None)
+
+
+def recalibrate_processed_file(savefile, table, chunksize=2**22):
+    """
+    Re-evaluate the energies of a processed data directory that was saved
+    with filtValues, using a TabulatedCalibration, without reopening the OFF
+    files. The energies column and the time index are rewritten in place.
+    """
+    channels = np.load(join(savefile, "channels.npy"), mmap_mode="r")
+    filtvalues = np.load(join(savefile, f"{FILTVALUE_COLUMN}.npy"), mmap_mode="r")
+    energies = np.load(join(savefile, "energies.npy"), mmap_mode="r+")
+    for start in range(0, len(energies), chunksize):
+        stop = start + chunksize
+        energies[start:stop] = table(channels[start:stop], filtvalues[start:stop])
+    energies.flush()
+    del energies, channels, filtvalues
+
+    columns = [
+        np.load(join(savefile, f"{name}.npy"), mmap_mode="r")
+        for name in PROCESSED_COLUMNS
+    ]
+    old_index = load_time_index(savefile)
+    if old_index is None:
+        index = make_time_index(*columns, block_size=TIME_INDEX_BLOCK)
+    else:
+        index = make_time_index(
+            *columns,
+            block_size=old_index["block_size"],
+            chanlist=old_index["block_channels"],
+        )
+    del columns
+    np.savez(join(savefile, TIME_INDEX_FILE), **index)
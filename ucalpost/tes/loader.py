@@ -1,4 +1,8 @@
 from os import path
+import threading
+from collections import deque, OrderedDict
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import mass
 import mass.off
 from mass.off import getOffFileListFromOneFile as getOffList
@@ -11,36 +15,179 @@ from ..databroker.run import (
     get_cal_id,
 )
 from .process import process, save_tes_arrays
+from .calibration import CALIBRATION_REGISTRY
 from .process_classes import get_analyzed_filename
 from ..tools.utils import merge_func
 
 # Need to do caching of open dataset
-# Just re-do drift_correct when new data comes in?
 # Just re-do calibration when new calibration data comes in?
 # Need to save data
 # Only works when cal and data are in same file
 
 
+def open_channel_group(off_filename):
+    return mass.off.ChannelGroup(getOffList(off_filename)[:1000], excludeStates=[])
+
+
+def off_basename(off_filename):
+    """
+    Name shared by the OFF files of every channel of a run
+    """
+    return "_".join(path.basename(off_filename).split("_")[:-1])
+
+
+def calibration_filename(savedir, off_filename, state):
+    """
+    The calibration file written for a state of an OFF file
+    """
+    savebase = off_basename(off_filename)
+    return path.join(savedir, f"{savebase}_{state}_cal.hdf5")
+
+
+def channel_group_nbytes(data):
+    """
+    Approximate memory held by a ChannelGroup, taken as the size of its
+    memory-mapped OFF records
+    """
+    total = 0
+    for ds in dict.values(data):
+        mmap = getattr(getattr(ds, "offFile", None), "_mmap", None)
+        total += getattr(mmap, "nbytes", 0)
+    return total
+
+
+def close_channel_group(data):
+    """
+    Release the OFF files of a ChannelGroup that is no longer used
+    """
+    for ds in dict.values(data):
+        offFile = getattr(ds, "offFile", None)
+        close = getattr(offFile, "close", None)
+        if close is not None:
+            close()
+        elif hasattr(offFile, "_mmap"):
+            offFile._mmap = None
+
+
+class ChannelGroupPool:
+    """
+    LRU pool of open ChannelGroups keyed by OFF basename, bounded by count
+    and by approximate memory. Evicted groups have their OFF files closed.
+    Groups that have been handed out, and groups marked active, i.e. those
+    used by the current run and its calibration, are never evicted until
+    the next set_active call.
+    """
+
+    def __init__(self, max_groups=4, max_bytes=None):
+        """
+        max_groups : number of ChannelGroups to keep open
+        max_bytes : optional cap on the channel_group_nbytes of the pool
+        """
+        self.max_groups = max_groups
+        self.max_bytes = max_bytes
+        self._groups = OrderedDict()
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def get(self, off_filename, refresh=True, pin=True):
+        """
+        Returns the ChannelGroup for off_filename, opening it if it is not in
+        the pool. Safe to call from a background thread.
+
+        refresh : If True, a group that was already open is refreshed from
+                  its files
+        pin : If True, the group is protected from eviction until the next
+              set_active call, so that it stays open while it is used
+        """
+        key = self._key(off_filename)
+        with self._lock:
+            if pin:
+                self._active.add(key)
+            data = self._groups.get(key, None)
+            if data is not None:
+                self._groups.move_to_end(key)
+        if data is not None:
+            if refresh:
+                data.refreshFromFiles()
+            return data
+        data = open_channel_group(off_filename)
+        with self._lock:
+            if key in self._groups:
+                # Opened concurrently by another thread, keep the first one
+                close_channel_group(data)
+                data = self._groups[key]
+            else:
+                self._groups[key] = data
+            self._groups.move_to_end(key)
+            self._evict(keep=key)
+        return data
+
+    @staticmethod
+    def _key(off_filename):
+        return path.join(path.dirname(off_filename), off_basename(off_filename))
+
+    def set_active(self, off_filenames):
+        """
+        Protect the groups of off_filenames from eviction, and release the
+        previously active and pinned ones. Called once the current run and
+        its calibration have their groups.
+        """
+        with self._lock:
+            self._active = {self._key(f) for f in off_filenames}
+            self._evict()
+
+    def _evict(self, keep=None):
+        def over_budget():
+            if len(self._groups) > self.max_groups:
+                return True
+            if self.max_bytes is None:
+                return False
+            total = sum(channel_group_nbytes(d) for d in self._groups.values())
+            return total > self.max_bytes
+
+        for key in list(self._groups):
+            if not over_budget():
+                break
+            if key in self._active or key == keep:
+                continue
+            close_channel_group(self._groups.pop(key))
+
+    def close(self):
+        with self._lock:
+            for data in self._groups.values():
+                close_channel_group(data)
+            self._groups.clear()
+            self._active = set()
+
+    def __contains__(self, off_filename):
+        return self._key(off_filename) in self._groups
+
+    def __len__(self):
+        return len(self._groups)
+
+
 class RawData:
-    def __init__(self, off_filename, state, savefile, data=None):
+    def __init__(self, off_filename, state, savefile, data=None, pool=None):
+        """
+        data : optional open ChannelGroup to use, if it includes off_filename
+        pool : optional ChannelGroupPool to get the ChannelGroup from
+        """
         self.off_filename = off_filename
         self.attribute = "filtValueDC"
         self.state = state
         self.savefile = savefile
+        self.pool = pool
         self.load_data(data)
         self.load_ds()
         self._calibrated = False
         self._calmd = {}
 
     def load_data(self, data=None):
-        if data is None:
-            data = mass.off.ChannelGroup(
-                getOffList(self.off_filename)[:1000], excludeStates=[]
-            )
-        elif self.off_filename not in data.offFileNames:
-            data = mass.off.ChannelGroup(
-                getOffList(self.off_filename)[:1000], excludeStates=[]
-            )
+        if data is None or self.off_filename not in data.offFileNames:
+            if self.pool is not None:
+                data = self.pool.get(self.off_filename)
+            else:
+                data = open_channel_group(self.off_filename)
         self.data = data
 
     def load_ds(self):
@@ -55,7 +202,7 @@ class RawData:
         self.refresh()
 
     def getProcessMd(self):
-        md = {"driftCorrected": self.driftCorrected, "calibration": self._calmd}
+        md = {"driftCorrected": self.hasDriftCorrection, "calibration": self._calmd}
         return md
 
     @property
@@ -66,12 +213,22 @@ class RawData:
             return False
 
     @property
-    def driftCorrected(self):
+    def hasDriftCorrection(self):
         try:
             return hasattr(self.ds, "filtValueDC")
         except:
             return False
 
+    @property
+    def driftCorrected(self):
+        """
+        True if the drift correction includes every pulse that has arrived
+        """
+        try:
+            return self.data.driftCorrectionCurrent()
+        except:
+            return False
+
 
 class CalibrationInfo(RawData):
     def __init__(self, off_filename, state, savefile, savedir, line_names, **kwargs):
@@ -93,10 +250,10 @@ class CalibrationInfo(RawData):
         else:
             self.savedir = savedir
         if savedir is not None:
-            savebase = "_".join(path.basename(self.off_filename).split("_")[:-1])
-            savename = f"{savebase}_{self.state}_cal.hdf5"
-            new_cal_file = path.join(savedir, savename)
+            new_cal_file = calibration_filename(savedir, self.off_filename, self.state)
             if new_cal_file != self.cal_file:
+                if self.cal_file is not None:
+                    CALIBRATION_REGISTRY.evict(self.cal_file)
                 self.cal_file = new_cal_file
                 self._calibrated = False
         else:
@@ -105,21 +262,32 @@ class CalibrationInfo(RawData):
 
 
 class AnalysisLoader:
-    def __init__(self, catalog):
+    def __init__(self, catalog, pool=None):
+        """
+        pool : ChannelGroupPool to keep OFF files open in. A pool of the
+               default size is created if None.
+        """
         self.catalog = catalog
         self.off_filename = None
         self.rd = None
         self.ci = None
+        self.pool = pool if pool is not None else ChannelGroupPool()
+
+    def prefetch(self, off_filename):
+        """
+        Open the ChannelGroup for off_filename ahead of time, so that the
+        next getAnalysisObjects call for it does not have to. Safe to call
+        from a background thread while another run is processed.
+        """
+        if off_filename not in self.pool:
+            self.pool.get(off_filename, refresh=False, pin=False)
 
     def getAnalysisObjects(self, run, cal=None, line_names=None):
         off_filename = get_filename(run)
         state = get_tes_state(run)
         savefile = get_analyzed_filename(run)
-        if self.rd is None:
-            self.rd = RawData(off_filename, state, savefile)
-            self.off_filename = off_filename
-        elif off_filename != self.off_filename:
-            self.rd = RawData(off_filename, state, savefile)
+        if self.rd is None or off_filename != self.off_filename:
+            self.rd = RawData(off_filename, state, savefile, pool=self.pool)
             self.off_filename = off_filename
         else:
             self.rd.update(state, savefile)
@@ -143,6 +311,7 @@ class AnalysisLoader:
                 cal_savedir,
                 line_names,
                 data=self.rd.data,
+                pool=self.pool,
             )
             self.cal_filename = cal_filename
         elif cal_filename != self.cal_filename:
@@ -153,10 +322,12 @@ class AnalysisLoader:
                 cal_savedir,
                 line_names,
                 data=self.rd.data,
+                pool=self.pool,
             )
             self.cal_filename = cal_filename
         else:
             self.ci.update(cal_state, cal_savefile, cal_savedir, line_names)
+        self.pool.set_active([self.rd.off_filename, self.ci.off_filename])
         return self.rd, self.ci
 
 
@@ -168,6 +339,10 @@ def process_run(
     redo=False,
     overwrite=False,
     line_names=None,
+    extract_workers=None,
+    append=False,
+    filtvalues=False,
+    tabulated=False,
     **kwargs,
 ):
     """
@@ -190,6 +365,19 @@ def process_run(
     overwrite : bool, optional
         If True, the processed data will be saved even if a file with the same name
         already exists. Default is False.
+    extract_workers : int, optional
+        If not None, the number of channels to read concurrently when saving
+        the TES arrays. Default is None.
+    append : bool, optional
+        If True and the run was already processed, only the pulses that arrived
+        since the processed file was last written are added to it. Default is False.
+    filtvalues : bool, optional
+        If True, the calibration attribute of each photon is saved with the
+        processed data, so that it can be recalibrated without the OFF files.
+        Default is False.
+    tabulated : bool, optional
+        If True, the energies are saved from a tabulated version of the
+        calibration file, evaluated for all channels at once. Default is False.
     **kwargs
         Additional keyword arguments to be passed to the processing function.
 
@@ -202,14 +390,303 @@ def process_run(
         loader = AnalysisLoader(catalog)
     rd, calinfo = loader.getAnalysisObjects(run, cal, line_names=line_names)
     print(f"Processing {rd.off_filename}, state: {rd.state}")
-    process(rd, calinfo, redo=redo, overwrite=overwrite, **kwargs)
+    process(rd, calinfo, redo=redo, overwrite=overwrite, append=append, **kwargs)
     print(f"Saving TES Arrays to {rd.savefile}")
-    save_tes_arrays(rd, overwrite=overwrite)
+    save_tes_arrays(
+        rd,
+        overwrite=overwrite,
+        workers=extract_workers,
+        append=append,
+        filtvalues=filtvalues,
+        tabulated=tabulated,
+    )
+
+
+def _skip_reason(run, skip_bad_ADR=True, skip_missing_ADR=False):
+    """
+    Returns the reason a run should not be processed, or None
+    """
+    if "tes" not in run.start.get("detectors", []):
+        return "TES not in detectors, skipping"
+    if skip_bad_ADR:
+        adr_threshold = 0.1
+        try:
+            last_adr_value = run.baseline["data"]["adr_heater"][1]
+        except (KeyError, AttributeError):
+            if skip_missing_ADR:
+                return f"run {run.start['scan_id']} has no ADR data in baseline, but ADR check was requested, not processing, moving on"
+            else:
+                last_adr_value = adr_threshold + 1
+        if last_adr_value < adr_threshold:
+            return f"Last ADR magnet value for run {run.start['scan_id']} was {last_adr_value}, skipping"
+    return None
+
+
+def _prepare_run(
+    run,
+    catalog,
+    default_cal,
+    loader,
+    skip_bad_ADR=True,
+    skip_missing_ADR=False,
+    parent_catalog=None,
+):
+    """
+    Read everything about a run that process_run needs before it can start,
+    i.e. its metadata, its calibration run, and the ChannelGroup of its OFF
+    file
+
+    Returns run, cal, catalog to process in, and the reason to skip the run
+    or None
+    """
+    reason = _skip_reason(run, skip_bad_ADR, skip_missing_ADR)
+    if reason is not None:
+        return run, None, None, reason
+    if parent_catalog is not None:
+        catalog = parent_catalog
+    if run.start.get("scantype", None) != "calibration":
+        cal = catalog[get_cal_id(run, default_cal)]
+    else:
+        cal = run
+    loader.prefetch(get_filename(run))
+    return run, cal, catalog, None
+
+
+def prefetched(func, items, depth=1):
+    """
+    Yield func(item) for each of items, computing the next depth results on
+    a background thread while the current one is used
+    """
+    pending = deque()
+    with ThreadPoolExecutor(1) as ex:
+        for item in items:
+            pending.append(ex.submit(func, item))
+            if len(pending) > depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _default_cal(ncat):
+    cal_ids = (
+        ncat.list_meta_key_vals("last_cal")
+        | ncat.filter_by_scantype("calibration").list_uid()
+    )
+    try:
+        return list(cal_ids)[0]
+    except IndexError:
+        print("No calibration present!")
+        raise
+
+
+def _process_noise_block(
+    ncat,
+    catalog,
+    loader,
+    skip_bad_ADR=True,
+    skip_missing_ADR=False,
+    parent_catalog=None,
+    prefetch=True,
+    catch_errors=False,
+    **kwargs,
+):
+    """
+    Process the runs of one noise block with loader
+
+    catch_errors : If True, a run that raises, while it is prepared or
+                   processed, is reported as failed and the remaining runs
+                   are still processed
+
+    Returns a list of per-run status dictionaries
+    """
+    report = []
+    scans = ncat.list_meta_key_vals("scan_id")
+    smin = min(scans)
+    smax = max(scans)
+    print(f"Processing from {smin} to {smax}")
+    default_cal = _default_cal(ncat)
+
+    def prepare(run):
+        try:
+            return _prepare_run(
+                run,
+                catalog,
+                default_cal,
+                loader,
+                skip_bad_ADR,
+                skip_missing_ADR,
+                parent_catalog,
+            )
+        except Exception as e:
+            if not catch_errors:
+                raise
+            # Reported as a failure by the loop below
+            return run, None, None, e
+
+    if prefetch:
+        prepared = prefetched(prepare, ncat.values())
+    else:
+        prepared = map(prepare, ncat.values())
+    for run, cal, run_catalog, reason in prepared:
+        print(f"Processing {run.start['scan_id']}")
+        status = {"scan_id": run.start["scan_id"], "uid": run.start["uid"]}
+        report.append(status)
+        if isinstance(reason, Exception):
+            print(f"Preparing {run.start['scan_id']} failed: {reason!r}")
+            status.update(status="failed", reason=repr(reason))
+            continue
+        if reason is not None:
+            print(reason)
+            status.update(status="skipped", reason=reason)
+            continue
+        try:
+            process_run(run, run_catalog, loader, cal, **kwargs)
+        except Exception as e:
+            if not catch_errors:
+                raise
+            print(f"Processing {run.start['scan_id']} failed: {e!r}")
+            status.update(status="failed", reason=repr(e))
+            continue
+        status.update(status="processed", reason=None)
+    return report
+
+
+def _block_outputs(ncat, catalog, parent_catalog=None):
+    """
+    The processed and calibration files that processing a noise block could
+    write, and the OFF files it opens, used to keep blocks that share any of
+    them in the same worker. Runs whose files cannot be determined write
+    nothing, since the worker will fail them too.
+    """
+    if parent_catalog is not None:
+        catalog = parent_catalog
+    outputs = set()
+    try:
+        default_cal = _default_cal(ncat)
+    except Exception:
+        return outputs
+    for run in ncat.values():
+        if "tes" not in run.start.get("detectors", []):
+            continue
+        try:
+            if run.start.get("scantype", None) != "calibration":
+                cal = catalog[get_cal_id(run, default_cal)]
+            else:
+                cal = run
+            run_outputs = {
+                get_filename(run),
+                get_filename(cal),
+                get_analyzed_filename(run),
+                get_analyzed_filename(cal),
+                calibration_filename(
+                    get_save_directory(cal), get_filename(cal), get_tes_state(cal)
+                ),
+            }
+        except Exception:
+            continue
+        outputs |= run_outputs
+    return outputs
+
+
+def _group_blocks(outputs):
+    """
+    Partition block indices so that blocks sharing any output file are in
+    the same group
+    """
+    parent = list(range(len(outputs)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    owner = {}
+    for i, files in enumerate(outputs):
+        for f in files:
+            if f in owner:
+                parent[find(i)] = find(owner[f])
+            else:
+                owner[f] = i
+    groups = {}
+    for i in range(len(outputs)):
+        groups.setdefault(find(i), []).append(i)
+    return list(groups.values())
+
+
+def close_http_connections(catalog):
+    """
+    Close the pooled HTTP connections of a (wrapped) tiled catalog client.
+    The client stays usable, and reconnects on its next request.
+    """
+    while hasattr(catalog, "_catalog"):
+        catalog = catalog._catalog
+    http_client = getattr(getattr(catalog, "context", None), "http_client", None)
+    transport = getattr(http_client, "_transport", None)
+    if transport is not None:
+        transport.close()
+
+
+_CATALOG_JOB = None
+
+
+def _process_blocks_forked(indices):
+    catalog, noise_catalogs, kwargs = _CATALOG_JOB
+    loader = AnalysisLoader(catalog)
+    report = []
+    for i in indices:
+        try:
+            block_report = _process_noise_block(
+                noise_catalogs[i], catalog, loader, catch_errors=True, **kwargs
+            )
+        except Exception as e:
+            print(f"Noise block {i} failed: {e!r}")
+            block_report = [{"status": "failed", "reason": repr(e)}]
+        for status in block_report:
+            status["block"] = i
+        report.extend(block_report)
+    return report
+
+
+def _process_catalog_parallel(catalog, noise_catalogs, workers, **kwargs):
+    global _CATALOG_JOB
+    parent_catalog = kwargs.get("parent_catalog", None)
+    outputs = [_block_outputs(ncat, catalog, parent_catalog) for ncat in noise_catalogs]
+    groups = _group_blocks(outputs)
+    print(f"Processing {len(noise_catalogs)} noise blocks in {len(groups)} groups")
+    # Catalog clients are not necessarily picklable, so the workers are
+    # forked and inherit them. Their pooled connections are closed first, so
+    # that each worker opens its own instead of sharing the parent's sockets.
+    close_http_connections(catalog)
+    close_http_connections(parent_catalog)
+    _CATALOG_JOB = (catalog, noise_catalogs, kwargs)
+    try:
+        ctx = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(workers, mp_context=ctx) as ex:
+            futures = [ex.submit(_process_blocks_forked, g) for g in groups]
+            report = []
+            for group, future in zip(groups, futures):
+                try:
+                    report.extend(future.result())
+                except Exception as e:
+                    print(f"Noise blocks {group} failed: {e!r}")
+                    report.append(
+                        {"block": group, "status": "failed", "reason": repr(e)}
+                    )
+    finally:
+        _CATALOG_JOB = None
+    return report
 
 
 @merge_func(process_run, ["run", "loader", "cal"])
 def process_catalog(
-    catalog, skip_bad_ADR=True, skip_missing_ADR=False, parent_catalog=None, **kwargs
+    catalog,
+    skip_bad_ADR=True,
+    skip_missing_ADR=False,
+    parent_catalog=None,
+    prefetch=True,
+    workers=None,
+    **kwargs,
 ):
     """
     Process a catalog of runs.
@@ -222,61 +699,38 @@ def process_catalog(
         If True, runs with bad ADR values will be skipped. Default is True.
     parent_catalog : object, optional
         The parent catalog of the catalog to be processed. If None, the catalog itself will be used. Default is None.
+    prefetch : bool, optional
+        If True, the metadata and OFF files of the next run are read on a
+        background thread while the current run is processed. Default is True.
+    workers : int, optional
+        If not None, noise blocks are processed in this many forked processes,
+        each with its own AnalysisLoader. Blocks that would write the same
+        processed or calibration file are processed by the same worker, and
+        a run that fails does not stop the others. Default is None.
     **kwargs
         Additional keyword arguments to be passed to the processing function.
 
     Returns
     -------
-    None
+    list of dict
+        The scan_id, uid, status ("processed", "skipped" or "failed") and
+        reason of each run, and its noise block index when run in parallel.
 
     """
+    noise_catalogs = list(catalog.get_subcatalogs(True, False, False, False))
+    block_kwargs = dict(
+        kwargs,
+        skip_bad_ADR=skip_bad_ADR,
+        skip_missing_ADR=skip_missing_ADR,
+        parent_catalog=parent_catalog,
+        prefetch=prefetch,
+    )
+    if workers is not None:
+        return _process_catalog_parallel(
+            catalog, noise_catalogs, workers, **block_kwargs
+        )
     loader = AnalysisLoader(catalog)
-    noise_catalogs = catalog.get_subcatalogs(True, False, False, False)
+    report = []
     for ncat in noise_catalogs:
-        scans = ncat.list_meta_key_vals("scan_id")
-        smin = min(scans)
-        smax = max(scans)
-        print(f"Processing from {smin} to {smax}")
-        cal_ids = (
-            ncat.list_meta_key_vals("last_cal")
-            | ncat.filter_by_scantype("calibration").list_uid()
-        )
-        try:
-            default_cal = list(cal_ids)[0]
-        except IndexError:
-            print("No calibration present!")
-            raise
-        for run in ncat.values():
-            print(f"Processing {run.start['scan_id']}")
-            if "tes" not in run.start.get("detectors", []):
-                print("TES not in detectors, skipping")
-                continue
-            if skip_bad_ADR:
-                adr_threshold = 0.1
-                try:
-                    last_adr_value = run.baseline["data"]["adr_heater"][1]
-                except (KeyError, AttributeError):
-                    if skip_missing_ADR:
-                        print(
-                            f"run {run.start['scan_id']} has no ADR data in baseline, but ADR check was requested, not processing, moving on"
-                        )
-                        continue
-                    else:
-                        last_adr_value = adr_threshold + 1
-                if last_adr_value < adr_threshold:
-                    print(
-                        f"Last ADR magnet value for run {run.start['scan_id']} was {last_adr_value}, skipping"
-                    )
-                    continue
-            if parent_catalog is not None:
-                if run.start.get("scantype", None) != "calibration":
-                    cal = parent_catalog[get_cal_id(run, default_cal)]
-                else:
-                    cal = run
-                process_run(run, parent_catalog, loader, cal, **kwargs)
-            else:
-                if run.start.get("scantype", None) != "calibration":
-                    cal = catalog[get_cal_id(run, default_cal)]
-                else:
-                    cal = run
-                process_run(run, catalog, loader, cal, **kwargs)
+        report.extend(_process_noise_block(ncat, catalog, loader, **block_kwargs))
+    return report
@@ -0,0 +1,75 @@
+import numpy as np
+
+"""
+Module for merging time-sorted per-channel photon streams
+"""
+
+
+def merge_chunks(keys, chunksize=2**22):
+    """
+    Plan a k-way merge of sorted arrays in bounded chunks
+
+    keys : list of k sorted arrays
+    chunksize : approximate number of elements per chunk
+
+    Yields (bounds, chunk, sort_idx) for each chunk, where bounds is a list
+    of (start, end) slices into each array, chunk is the concatenation of
+    those slices, and sort_idx orders the chunk. Chunks are cut at a key that no array
+    passes by more than chunksize // k elements, and all elements equal to
+    that key are taken, so consecutive chunks never overlap.
+    """
+    k = len(keys)
+    per_stream = max(chunksize // max(k, 1), 1)
+    pos = [0] * k
+    lengths = [len(a) for a in keys]
+    while any(p < n for p, n in zip(pos, lengths)):
+        kmax = min(
+            a[min(p + per_stream, n) - 1]
+            for a, p, n in zip(keys, pos, lengths)
+            if p < n
+        )
+        bounds = []
+        for i, a in enumerate(keys):
+            end = pos[i] + np.searchsorted(a[pos[i] :], kmax, side="right")
+            bounds.append((pos[i], end))
+            pos[i] = end
+        chunk = np.concatenate([a[s:e] for a, (s, e) in zip(keys, bounds)])
+        # The chunk is a concatenation of k sorted runs, which the stable
+        # (timsort) argsort merges in O(n log k)
+        yield bounds, chunk, np.argsort(chunk, kind="stable")
+
+
+def kway_merge(keys, values=(), out=None, chunksize=2**22):
+    """
+    Merge k sorted arrays, carrying along parallel value arrays
+
+    keys : list of k sorted arrays
+    values : list of columns to merge alongside the keys. Each column is a
+             list of k arrays the same length as the keys, or a list of k
+             scalars that are broadcast (e.g. a channel number per stream)
+    out : optional list of preallocated output arrays, one for the keys
+          and one per column, e.g. memory-mapped files. If None, they are
+          allocated once at full size.
+    chunksize : approximate number of elements merged at a time
+
+    Returns the list of output arrays, keys first
+    """
+    total = sum(len(a) for a in keys)
+    if out is None:
+        out = [np.empty(total, dtype=np.result_type(*keys) if keys else float)]
+        for col in values:
+            out.append(np.empty(total, dtype=np.result_type(*col)))
+    written = 0
+    for bounds, chunk, sort_idx in merge_chunks(keys, chunksize):
+        n = len(sort_idx)
+        out[0][written : written + n] = chunk[sort_idx]
+        for col, arr in zip(values, out[1:]):
+            chunk = np.concatenate(
+                [
+                    v[s:e] if np.ndim(v) else np.full(e - s, v)
+                    for v, (s, e) in zip(col, bounds)
+                ]
+            )
+            arr[written : written + n] = chunk[sort_idx]
+        written += n
+    return out
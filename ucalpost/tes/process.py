@@ -1,21 +1,52 @@
 # import mass
 import os
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
 import yaml
 
-from .calibration import summarize_calibration, make_calibration, load_calibration
+from .calibration import (
+    summarize_calibration,
+    make_calibration,
+    load_calibration,
+    state_slices,
+    tabulate_calibration,
+)
+from .process_classes import (
+    save_processed_streams,
+    append_processed_streams,
+    existing_processed_file,
+)
+from .energy import recalibrate_processed_file, DEFAULT_KNOTS
+from .drift import DC_STALENESS_LIMIT, DC_GAIN_TOLERANCE
 
 
-# Understand how to intelligently re-drift-correct as data comes in
 def _drift_correct(data):
     data.learnDriftCorrection()
 
 
-def drift_correct(rd):
+def drift_correct(rd, incremental=False, staleness_limit=DC_STALENESS_LIMIT):
     """
     rd : A RawData object
+    incremental : If True, the drift correction is a DriftTracker, and the
+                  pulses that arrived since it was learned, e.g. after
+                  RawData.refresh(), are added to it. Otherwise mass's
+                  learnDriftCorrection is run once.
+    staleness_limit : fraction of pulses outside of a channel's drift
+                      correction histogram above which it is relearned from
+                      every pulse, see DriftTracker
     """
-    if not rd.driftCorrected:
+    if incremental:
+        if rd.driftCorrected:
+            print("Drift Correction already done")
+            return
+        if rd.hasDriftCorrection:
+            print("Updating Drift Correction")
+        else:
+            print("Drift Correcting")
+        rd.data.updateDriftCorrection(staleness_limit=staleness_limit)
+        rd.load_ds()
+    elif not rd.hasDriftCorrection:
         print("Drift Correcting")
         _drift_correct(rd.data)
         rd.load_ds()
@@ -23,20 +54,64 @@ def drift_correct(rd):
         print("Drift Correction already done")
 
 
-# Need to determine when to re-calibrate
-def calibrate(rd, calinfo, redo=False, overwrite=False, rms_cutoff=2, **kwargs):
+def drift_changed(calinfo, tolerance=DC_GAIN_TOLERANCE):
+    """
+    True if the drift correction changed by more than tolerance since the
+    calibration of calinfo was made
+    """
+    snapshot = getattr(calinfo, "drift_snapshot", None)
+    if not snapshot:
+        return False
+    return calinfo.data.driftCorrectionChange(snapshot) > tolerance
+
+
+def saved_arrays_stale(rd, md, tolerance=DC_GAIN_TOLERANCE):
+    """
+    True if the photons of a processed file, with metadata md, were saved
+    with a different calibration than the one loaded in rd, or with a drift
+    correction that has since changed by more than tolerance
+    """
+    if md.get("calibration", {}) != rd._calmd:
+        return True
+    snapshot = md.get("drift_snapshot", None)
+    if not snapshot:
+        return False
+    return rd.data.driftCorrectionChange(snapshot) > tolerance
+
+
+def calibrate(
+    rd,
+    calinfo,
+    redo=False,
+    overwrite=False,
+    rms_cutoff=2,
+    drift_tolerance=DC_GAIN_TOLERANCE,
+    **kwargs,
+):
     """
     rd : A RawData object
     calinfo : a CalibrationInfo object
     redo : Whether we should re-calibrate even if calibration is loaded
     overwrite : If we should ignore already on-disk calibration,
                 passed to make_calibration, summarize_calibration, and save_tes_arrays
+    drift_tolerance : If an incremental drift correction changed by more than
+                      this since the calibration was made, the calibration
+                      is redone and overwritten, see drift_changed. Files
+                      that save_tes_arrays appends to are then rewritten.
+    kwargs : passed to make_calibration and on to ChannelGroup.calibrate,
+             e.g. binsize and hmax of the histograms that peaks are found in
     """
+    if drift_changed(calinfo, drift_tolerance):
+        print("Drift correction changed since calibration")
+        overwrite = True
+        redo = True
+        rd._calibrated = False
     if not calinfo.calibrated or redo:
         print(f"Calibrating {calinfo.state}")
         make_calibration(calinfo, overwrite=overwrite, rms_cutoff=rms_cutoff, **kwargs)
         summarize_calibration(calinfo, overwrite=overwrite)
         save_tes_arrays(calinfo, overwrite=overwrite)
+        calinfo.drift_snapshot = calinfo.data.driftSnapshot()
     else:
         print("Calibration already present")
     if not rd.calibrated:
@@ -47,62 +122,296 @@ def calibrate(rd, calinfo, redo=False, overwrite=False, rms_cutoff=2, **kwargs):
 
 
 def process(
-    rd, calinfo, redo=False, rms_cutoff=0.2, dc=True, overwrite=False, **cal_kwargs
+    rd,
+    calinfo,
+    redo=False,
+    rms_cutoff=0.2,
+    dc=True,
+    overwrite=False,
+    append=False,
+    incremental_dc=False,
+    **cal_kwargs,
 ):
+    """
+    rd : A RawData object
+    calinfo : a CalibrationInfo object
+    dc : If True, drift correct rd and calinfo before calibrating
+    incremental_dc : If True, use an incremental drift correction, and
+                     recalibrate when it changes, see drift_correct
+    """
     savefile = rd.savefile
     metafile = os.path.splitext(rd.savefile)[0] + ".yaml"
     state = rd.state
     savedir = os.path.dirname(savefile)
     if not os.path.exists(savedir):
         os.makedirs(savedir)
-    if os.path.exists(savefile) and not overwrite:
-        print(f"Not going to overwrite {savefile}, moving on")
+    existing = existing_processed_file(savefile, state)
+    # Only the processed data directory can be appended to
+    if existing is not None and not overwrite and not (append and existing == savefile):
+        print(f"Not going to overwrite {existing}, moving on")
         return
 
     if dc:
-        drift_correct(rd)
-        drift_correct(calinfo)
+        drift_correct(rd, incremental_dc)
+        drift_correct(calinfo, incremental_dc)
     calibrate(
         rd, calinfo, redo=redo, rms_cutoff=rms_cutoff, overwrite=overwrite, **cal_kwargs
     )
 
 
-def save_tes_arrays(rd, overwrite=False):
+def _get_new_pulses(ds, state, since, attrs):
+    """
+    Read only the pulses of a state that arrived after unixnano since,
+    so that the energy recipe is only evaluated for the new pulses
+    """
+    columns = []
+    for inds in state_slices(ds, state):
+        raw_uns = ds.offFile["unixnano"][inds]
+        start = inds.start or 0
+        first_new = start + np.searchsorted(raw_uns, since, side="right")
+        columns.append(ds.getAttr(attrs, slice(first_new, inds.stop)))
+    return [np.concatenate(c) for c in zip(*columns)]
+
+
+def _get_channel_stream(ds, state, since=None, filtvalue_attr=None, energy=True):
+    attrs = ["unixnano"]
+    if energy:
+        attrs.append("energy")
+    if filtvalue_attr is not None:
+        attrs.append(filtvalue_attr)
+    try:
+        if since is None:
+            return ds.getAttr(attrs, state)
+        else:
+            return _get_new_pulses(ds, state, since, attrs)
+    except:
+        return None
+
+
+_EXTRACT_GROUP = None
+
+
+def _get_channel_stream_forked(channum, state, since, filtvalue_attr, energy):
+    return _get_channel_stream(
+        _EXTRACT_GROUP[channum], state, since, filtvalue_attr, energy
+    )
+
+
+def extract_channel_streams(
+    data,
+    state,
+    workers=None,
+    executor="thread",
+    since=None,
+    filtvalue_attr=None,
+    energy_table=None,
+):
+    """
+    Read timestamps and energies for every channel in a ChannelGroup
+
+    data : a mass.off.ChannelGroup
+    state : the state to extract
+    workers : If not None, the number of channels to extract concurrently
+    executor : "thread" or "process". The process pool is forked, so that
+               workers inherit the open ChannelGroup
+    since : optional dictionary of {channum: unixnano}. Only pulses after
+            these times are read for the listed channels.
+    filtvalue_attr : optional attribute, e.g. "filtValueDC", to read
+                     along with the energies
+    energy_table : optional TabulatedCalibration. The energies of every
+                   channel are then evaluated from its attr in one pass,
+                   instead of through each channel's energy recipe.
+
+    Returns a list of (timestamps, energies, channum) tuples, or
+    (timestamps, energies, channum, filtvalues) tuples if filtvalue_attr is
+    given. Channels that fail are marked bad.
+    """
+    global _EXTRACT_GROUP
+    if since is None:
+        since = {}
+    keep_filtvalues = filtvalue_attr is not None
+    read_energy = energy_table is None
+    if energy_table is not None:
+        if keep_filtvalues and filtvalue_attr != energy_table.attr:
+            raise ValueError(
+                f"Cannot save {filtvalue_attr} with a calibration of {energy_table.attr}"
+            )
+        filtvalue_attr = energy_table.attr
+    channels = list(data.values())
+    channel_since = [since.get(ds.channum, None) for ds in channels]
+    if workers is None:
+        results = [
+            _get_channel_stream(ds, state, t, filtvalue_attr, read_energy)
+            for ds, t in zip(channels, channel_since)
+        ]
+    elif executor == "thread":
+        with ThreadPoolExecutor(workers) as ex:
+            results = list(
+                ex.map(
+                    lambda ds, t: _get_channel_stream(
+                        ds, state, t, filtvalue_attr, read_energy
+                    ),
+                    channels,
+                    channel_since,
+                )
+            )
+    elif executor == "process":
+        _EXTRACT_GROUP = data
+        try:
+            ctx = multiprocessing.get_context("fork")
+            with ProcessPoolExecutor(workers, mp_context=ctx) as ex:
+                results = list(
+                    ex.map(
+                        _get_channel_stream_forked,
+                        [ds.channum for ds in channels],
+                        [state] * len(channels),
+                        channel_since,
+                        [filtvalue_attr] * len(channels),
+                        [read_energy] * len(channels),
+                    )
+                )
+        finally:
+            _EXTRACT_GROUP = None
+    else:
+        raise ValueError(f"Unknown executor {executor}, use 'thread' or 'process'")
+    streams = []
+    for ds, result in zip(channels, results):
+        if result is None:
+            print(f"{ds.channum} failed")
+            ds.markBad("Failed to get energy")
+            continue
+        streams.append((result[0], result[1], ds.channum) + tuple(result[2:]))
+    if energy_table is None:
+        return streams
+    # Evaluate every channel's energies at once, then split them back up
+    lengths = [len(stream[0]) for stream in streams]
+    values = np.concatenate([[]] + [stream[1] for stream in streams])
+    channums = np.repeat([stream[2] for stream in streams], lengths)
+    energies = np.split(energy_table(channums, values), np.cumsum(lengths)[:-1])
+    if keep_filtvalues:
+        return [(s[0], e, s[2], s[1]) for s, e in zip(streams, energies)]
+    return [(s[0], e, s[2]) for s, e in zip(streams, energies)]
+
+
+def _last_unixnano(streams, previous=None):
+    last = dict(previous or {})
+    for stream in streams:
+        uns, channum = stream[0], stream[2]
+        if len(uns) > 0:
+            last[int(channum)] = max(int(uns[-1]), last.get(int(channum), 0))
+    return last
+
+
+def save_tes_arrays(
+    rd,
+    overwrite=False,
+    workers=None,
+    executor="thread",
+    append=False,
+    filtvalues=False,
+    tabulated=False,
+    drift_tolerance=DC_GAIN_TOLERANCE,
+):
+    """
+    rd : A RawData object
+    overwrite : If we should overwrite an existing savefile
+    workers : If not None, extract this many channels concurrently
+    executor : "thread" or "process", see extract_channel_streams
+    append : If the savefile exists, only add the pulses that arrived since
+             it was last written, e.g. after RawData.refresh(). The whole
+             file is rewritten instead if the calibration or the drift
+             correction changed since then, see saved_arrays_stale
+    filtvalues : If True, also save the calibration attribute of each
+                 photon, so that the file can be recalibrated with
+                 recalibrate_tes_arrays
+    tabulated : If True, the energies of all channels are evaluated in bulk
+                from a TabulatedCalibration of the loaded calibration file,
+                instead of through each channel's energy recipe
+    drift_tolerance : passed to saved_arrays_stale
+    """
+    energy_table = None
+    if tabulated:
+        cal_file = rd._calmd.get("cal_file", None)
+        if cal_file is None:
+            raise ValueError(f"{rd.off_filename} has no calibration file to tabulate")
+        energy_table = tabulate_calibration(cal_file)
+    if energy_table is not None and filtvalues:
+        filtvalue_attr = energy_table.attr
+    elif filtvalues:
+        filtvalue_attr = "filtValueDC" if rd.hasDriftCorrection else "filtValue"
+    else:
+        filtvalue_attr = None
     savefile = rd.savefile
     metafile = os.path.splitext(rd.savefile)[0] + ".yaml"
     state = rd.state
     savedir = os.path.dirname(savefile)
     if not os.path.exists(savedir):
         os.makedirs(savedir)
-    if os.path.exists(savefile) and not overwrite:
-        print(f"Not overwriting {savefile}")
-        return
-
-    timestamps = []
-    energies = []
-    channels = []
-    for ds in rd.data.values():
-        try:
-            uns, es = ds.getAttr(["unixnano", "energy"], state)
-        except:
-            print(f"{ds.channum} failed")
-            ds.markBad("Failed to get energy")
-            continue
-        ch = np.zeros_like(uns) + ds.channum
-        timestamps.append(uns)
-        energies.append(es)
-        channels.append(ch)
-    ts_arr = np.concatenate(timestamps)
-    en_arr = np.concatenate(energies)
-    ch_arr = np.concatenate(channels)
-    sort_idx = np.argsort(ts_arr)
-    print(f"Saving {savefile}")
-    np.savez(
-        savefile,
-        timestamps=ts_arr[sort_idx],
-        energies=en_arr[sort_idx],
-        channels=ch_arr[sort_idx],
-    )
+    last = None
+    if existing_processed_file(savefile, state) is not None and not overwrite:
+        if append and os.path.isdir(savefile) and os.path.exists(metafile):
+            with open(metafile, "r") as f:
+                saved_md = yaml.safe_load(f)
+            last = saved_md.get("last_unixnano", None)
+            if last is not None and saved_arrays_stale(rd, saved_md, drift_tolerance):
+                print(f"Calibration or drift correction of {savefile} changed")
+                overwrite = True
+                last = None
+        if last is None and not overwrite:
+            print(f"Not overwriting {savefile}")
+            return
+    if last is not None:
+        streams = extract_channel_streams(
+            rd.data, state, workers, executor, last, filtvalue_attr, energy_table
+        )
+        print(f"Appending to {savefile}")
+        append_processed_streams(savefile, streams)
+    else:
+        streams = extract_channel_streams(
+            rd.data,
+            state,
+            workers,
+            executor,
+            filtvalue_attr=filtvalue_attr,
+            energy_table=energy_table,
+        )
+        last = {}
+        print(f"Saving {savefile}")
+        save_processed_streams(savefile, streams)
     md = rd.getProcessMd()
+    md["last_unixnano"] = _last_unixnano(streams, last)
+    snapshot = rd.data.driftSnapshot()
+    if snapshot:
+        md["drift_snapshot"] = {int(c): list(s) for c, s in snapshot.items()}
+    if filtvalue_attr is not None:
+        md["filtvalue_attr"] = filtvalue_attr
+    with open(metafile, "w") as f:
+        yaml.dump(md, f)
+
+
+def recalibrate_tes_arrays(savefile, cal_file, nknots=DEFAULT_KNOTS):
+    """
+    Re-evaluate the energies of a processed file saved with filtvalues=True
+    using the calibration in cal_file, without opening the OFF files
+
+    savefile : processed data directory
+    cal_file : calibration HDF5 file
+    nknots : number of points each calibration curve is tabulated on
+    """
+    metafile = os.path.splitext(savefile)[0] + ".yaml"
+    md = {}
+    if os.path.exists(metafile):
+        with open(metafile, "r") as f:
+            md = yaml.safe_load(f)
+    table = tabulate_calibration(cal_file, nknots)
+    saved_attr = md.get("filtvalue_attr", None)
+    if saved_attr != table.attr:
+        raise ValueError(
+            f"{cal_file} calibrates {table.attr}, but {savefile} has "
+            f"{saved_attr} saved"
+        )
+    print(f"Recalibrating {savefile} from {cal_file}")
+    recalibrate_processed_file(savefile, table)
+    md.setdefault("calibration", {})["cal_file"] = cal_file
     with open(metafile, "w") as f:
         yaml.dump(md, f)
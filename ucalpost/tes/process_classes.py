@@ -1,13 +1,16 @@
 import numpy as np
+import io
 import os
-from os.path import exists, join, basename
+from os.path import exists, join, basename, dirname
 import json
+from collections import OrderedDict
 from ..databroker.run import (
     get_save_directory,
     get_tes_state,
     get_logname,
     get_filename,
 )
+from .merge import kway_merge
 import matplotlib.pyplot as plt
 
 """
@@ -15,42 +18,381 @@ Module for loading and working with processed energy/timestamp data
 """
 
 
+PROCESSED_COLUMNS = ("timestamps", "energies", "channels")
+# Optional column of the calibration attribute, for recalibrating in place
+FILTVALUE_COLUMN = "filtvalues"
+TIME_INDEX_FILE = "time_index.npz"
+TIME_INDEX_BLOCK = 65536
+
+
+def seconds_to_ns(t):
+    """
+    Convert times in seconds to integer nanoseconds, rounding up so that
+    searchsorted on nanosecond timestamps matches a search in seconds
+    """
+    return np.ceil(np.asarray(t, dtype=float) * 1e9).astype(np.int64)
+
+
+def make_time_index(
+    timestamps,
+    energies,
+    channels,
+    block_size=TIME_INDEX_BLOCK,
+    chanlist=None,
+    blocks_per_pass=64,
+):
+    """
+    Summarize a processed photon list in blocks of block_size photons
+
+    chanlist : optional list of all channels present, saves a pass over the data
+    blocks_per_pass : number of blocks to read at once, bounds memory use for
+                      memory-mapped arrays
+
+    Returns a dictionary with the timestamp of the first photon of each
+    block, the per-block per-channel counts, and the per-block energy range
+    """
+    ntimes = len(timestamps)
+    nblocks = -(-ntimes // block_size)
+    step = block_size * blocks_per_pass
+    if chanlist is None:
+        block_channels = np.zeros(0, dtype=channels.dtype)
+        for i in range(0, ntimes, step):
+            block_channels = np.union1d(block_channels, channels[i : i + step])
+    else:
+        block_channels = np.unique(chanlist)
+    nchans = len(block_channels)
+    block_counts = np.zeros((nblocks, nchans), dtype=np.int64)
+    block_emin = np.zeros(nblocks, dtype=energies.dtype)
+    block_emax = np.zeros(nblocks, dtype=energies.dtype)
+    for i in range(0, ntimes, step):
+        chans = channels[i : i + step]
+        e = energies[i : i + step]
+        b0 = i // block_size
+        nb = -(-len(chans) // block_size)
+        block_idx = np.arange(len(chans)) // block_size
+        chan_idx = np.searchsorted(block_channels, chans)
+        block_counts[b0 : b0 + nb] = np.bincount(
+            block_idx * nchans + chan_idx, minlength=nb * nchans
+        ).reshape(nb, nchans)
+        offsets = np.arange(nb) * block_size
+        # NaN energies propagate, so blocks containing them never pass the
+        # range check of sum_roi_between_times
+        block_emin[b0 : b0 + nb] = np.minimum.reduceat(e, offsets)
+        block_emax[b0 : b0 + nb] = np.maximum.reduceat(e, offsets)
+    return {
+        "block_size": block_size,
+        "block_times": np.asarray(timestamps[::block_size]),
+        "block_channels": block_channels,
+        "block_counts": block_counts,
+        "block_emin": block_emin,
+        "block_emax": block_emax,
+    }
+
+
 class ProcessedData:
-    def __init__(self, timestamps, energies, channels):
+    def __init__(self, timestamps, energies, channels, index=None, filename=None):
+        """
+        timestamps : integer nanosecond timestamps, sorted
+        energies : photon energies
+        channels : channel number of each photon
+        index : optional time index, from make_time_index
+        filename : optional processed data directory the arrays were opened
+                   from, used by refresh
+
+        The arrays may be memory-mapped, and are never copied as a whole.
+        Query times are given in seconds and converted to nanoseconds.
+        """
         self.timestamps = timestamps
         self.energies = energies
         self.channels = channels
-        self.chanlist = sorted(list(set(channels)))
+        self.index = index
+        self.filename = filename
+        self._chanlist = None
+        self._channel_index = None
+
+    @property
+    def nbytes(self):
+        """
+        Approximate memory held by this object. Memory-mapped columns are
+        backed by the page cache, and are not counted.
+        """
+        arrays = [self.timestamps, self.energies, self.channels]
+        if self._channel_index is not None:
+            arrays.extend(self._channel_index)
+        return sum(_array_nbytes(a) for a in arrays)
+
+    def refresh(self, mmap_mode="r"):
+        """
+        Re-open the columns if the processed data directory has grown, e.g.
+        from append_processed_streams. Only the memory maps and the small
+        time index are re-opened.
+
+        Returns True if new data was found
+        """
+        if self.filename is None or not os.path.isdir(self.filename):
+            return False
+        ntimes = _npy_length(join(self.filename, "timestamps.npy"))
+        if ntimes == len(self.timestamps):
+            return False
+        self.timestamps, self.energies, self.channels = [
+            np.load(join(self.filename, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in PROCESSED_COLUMNS
+        ]
+        self.index = load_time_index(self.filename)
+        self._chanlist = None
+        self._channel_index = None
+        return True
+
+    @property
+    def chanlist(self):
+        if self._chanlist is None:
+            if self.index is not None:
+                self._chanlist = self.index["block_channels"].tolist()
+            else:
+                self._chanlist = np.unique(self.channels).tolist()
+        return self._chanlist
+
+    @property
+    def channel_index(self):
+        """
+        Channel-major view of the photon list, built once on first use
+
+        Returns (chan_ids, offsets, order, chan_timestamps), where
+        order[offsets[i]:offsets[i + 1]] are the time-sorted photon indices of
+        channel chan_ids[i], and chan_timestamps = timestamps[order]
+        """
+        if self._channel_index is None:
+            order = np.argsort(self.channels, kind="stable")
+            sorted_chans = self.channels[order]
+            chan_ids = np.unique(sorted_chans)
+            offsets = np.append(np.searchsorted(sorted_chans, chan_ids), len(order))
+            chan_timestamps = self.timestamps[order]
+            self._channel_index = (chan_ids, offsets, order, chan_timestamps)
+        return self._channel_index
+
+    def channel_indices_between_times(self, starts, stops, channels):
+        """
+        Find the photons of each selected channel in every time window
+
+        Returns (idx1, idx2, points) arrays, where idx1/idx2 index into the
+        channel-major order of channel_index, and points gives the window
+        that each (idx1, idx2) pair belongs to
+        """
+        chan_ids, offsets, order, chan_timestamps = self.channel_index
+        starts_ns = seconds_to_ns(np.atleast_1d(starts))
+        stops_ns = seconds_to_ns(np.atleast_1d(stops))
+        npts = len(starts_ns)
+        chan_pos = np.flatnonzero(np.isin(chan_ids, channels))
+        idx1 = []
+        idx2 = []
+        for c in chan_pos:
+            lo, hi = offsets[c], offsets[c + 1]
+            segment = chan_timestamps[lo:hi]
+            idx1.append(lo + np.searchsorted(segment, starts_ns))
+            idx2.append(lo + np.searchsorted(segment, stops_ns))
+        if len(idx1) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty
+        idx1 = np.concatenate(idx1)
+        idx2 = np.maximum(idx1, np.concatenate(idx2))
+        points = np.tile(np.arange(npts), len(idx1) // npts)
+        return idx1, idx2, points
+
+    def _search_times(self, t_ns):
+        """
+        searchsorted on the timestamps. With a time index, only the block
+        that contains each time is read, by a binary search that is
+        vectorized over the times.
+        """
+        if self.index is None:
+            return np.searchsorted(self.timestamps, t_ns)
+        block_size = self.index["block_size"]
+        ntimes = len(self.timestamps)
+        blocks = np.searchsorted(self.index["block_times"], t_ns)
+        # block_times[b - 1] < t <= block_times[b], so the result lies in
+        # the block starting at (b - 1) * block_size
+        t = np.atleast_1d(t_ns)
+        lo = np.atleast_1d(np.maximum(blocks - 1, 0) * block_size).astype(np.int64)
+        hi = np.atleast_1d(np.minimum(blocks * block_size, ntimes)).astype(np.int64)
+        active = lo < hi
+        while np.any(active):
+            mid = (lo[active] + hi[active]) // 2
+            below = self.timestamps[mid] < t[active]
+            lo[active] = np.where(below, mid + 1, lo[active])
+            hi[active] = np.where(below, hi[active], mid)
+            active = lo < hi
+        if np.ndim(t_ns) == 0:
+            return lo[0]
+        return lo
 
     def index_between_times(self, start, stop):
-        idx1 = np.searchsorted(self.timestamps, start)
-        idx2 = np.searchsorted(self.timestamps, stop)
+        idx1 = self._search_times(seconds_to_ns(start))
+        idx2 = self._search_times(seconds_to_ns(stop))
         return idx1, idx2
 
-    def select_between_times(self, start, stop, channels=None):
+    def count_between_times(self, start, stop, channels=None):
+        """
+        Count photons between two times. With a time index, whole blocks are
+        counted from the block summaries and only the partial blocks at the
+        edges of the window are read.
+        """
         idx1, idx2 = self.index_between_times(start, stop)
-        e = self.energies[idx1:idx2]
+        if idx2 <= idx1:
+            return 0
+        if self.index is None:
+            return self._count_channels(idx1, idx2, channels)
+        block_size = self.index["block_size"]
+        b1 = -(-idx1 // block_size)
+        b2 = idx2 // block_size
+        if b2 <= b1:
+            return self._count_channels(idx1, idx2, channels)
+        block_counts = self.index["block_counts"][b1:b2]
         if channels is not None:
-            chans = self.channels[idx1:idx2]
-            chansel = np.array(channels)
-            if len(chansel) > 1:
-                chans = chans[np.newaxis, :]
-                chansel = chansel[:, np.newaxis]
-                chan_idx = np.any(chans == chansel, axis=0)
-            else:
-                chan_idx = chans == chansel
-            e = e[chan_idx]
-        return e
+            cols = np.isin(self.index["block_channels"], channels)
+            block_counts = block_counts[:, cols]
+        count = int(np.sum(block_counts))
+        count += self._count_channels(idx1, b1 * block_size, channels)
+        count += self._count_channels(b2 * block_size, idx2, channels)
+        return count
+
+    def _count_channels(self, idx1, idx2, channels=None):
+        if channels is None:
+            return max(idx2 - idx1, 0)
+        return int(np.count_nonzero(np.isin(self.channels[idx1:idx2], channels)))
+
+    def select_between_times(self, start, stop, channels=None):
+        if channels is not None:
+            photon_idx, _ = self.photons_between_times(start, stop, channels)
+            # Keep the photons in time order, as for an unfiltered selection
+            return self.energies[np.sort(photon_idx)]
+        idx1, idx2 = self.index_between_times(start, stop)
+        return self.energies[idx1:idx2]
 
     def sum_roi_between_times(self, start, stop, llim, ulim, channels=None):
+        if self.index is not None:
+            idx1, idx2 = self.index_between_times(start, stop)
+            block_size = self.index["block_size"]
+            b1 = idx1 // block_size
+            b2 = -(-idx2 // block_size)
+            if b2 > b1:
+                emin = np.min(self.index["block_emin"][b1:b2])
+                emax = np.max(self.index["block_emax"][b1:b2])
+                if llim < emin and ulim > emax:
+                    # The ROI contains every photon, so only counts are needed
+                    return self.count_between_times(start, stop, channels=channels)
         energies = self.select_between_times(start, stop, channels=channels)
         return np.sum((energies < ulim) & (energies > llim))
 
+    def indices_between_times(self, starts, stops):
+        """
+        Vectorized version of index_between_times for arrays of start/stop times
+        """
+        idx1 = self._search_times(seconds_to_ns(np.atleast_1d(starts)))
+        idx2 = self._search_times(seconds_to_ns(np.atleast_1d(stops)))
+        # An inverted window selects nothing, as with a slice
+        idx2 = np.maximum(idx1, idx2)
+        return idx1, idx2
+
+    def gather_points(self, idx1, idx2, points=None):
+        """
+        Map every photon inside a scan point onto the index of that point
+
+        idx1, idx2 : arrays of start/stop indices, from indices_between_times
+        points : optional point index of each (idx1, idx2) pair, defaults
+                 to one pair per point
+
+        Returns (photon_idx, point_idx) arrays. A photon in overlapping
+        points appears once for each point.
+        """
+        if points is None:
+            points = np.arange(len(idx1))
+        lengths = idx2 - idx1
+        point_idx = np.repeat(points, lengths)
+        offsets = np.cumsum(lengths) - lengths
+        photon_idx = np.arange(lengths.sum()) + np.repeat(idx1 - offsets, lengths)
+        return photon_idx, point_idx
+
+    def photons_between_times(self, starts, stops, channels=None):
+        """
+        Find the photons in every time window, optionally restricted to a set
+        of channels through the channel index, so that memory use is
+        proportional to the number of selected photons
+
+        Returns (photon_idx, point_idx) arrays, as for gather_points
+        """
+        if channels is None:
+            idx1, idx2 = self.indices_between_times(starts, stops)
+            return self.gather_points(idx1, idx2)
+        idx1, idx2, points = self.channel_indices_between_times(starts, stops, channels)
+        order_idx, point_idx = self.gather_points(idx1, idx2, points)
+        order = self.channel_index[2]
+        return order[order_idx], point_idx
+
+    def sum_rois_between_times(self, starts, stops, rois, channels=None):
+        """
+        Count photons in several ROIs for every scan point in a single pass
+
+        starts, stops : arrays of scan point start and stop times
+        rois : list of (llim, ulim) tuples
+        channels : optional list of channels to include
+
+        Returns an (n_points, n_rois) array of counts
+        """
+        npts = len(np.atleast_1d(starts))
+        photon_idx, point_idx = self.photons_between_times(starts, stops, channels)
+        e = self.energies[photon_idx]
+        roi_lims = np.asarray(rois, dtype=float).reshape(-1, 2)
+        edges = np.unique(roi_lims)
+        # Photons between two edges land in even cells, and photons exactly on
+        # an edge in odd cells, so the strict ROI limits are kept exact
+        cells = np.digitize(e, edges) + np.digitize(e, edges, right=True)
+        ncells = 2 * len(edges) + 1
+        hist = np.bincount(point_idx * ncells + cells, minlength=npts * ncells).reshape(
+            npts, ncells
+        )
+        csum = np.zeros((npts, ncells + 1), dtype=np.int64)
+        np.cumsum(hist, axis=1, out=csum[:, 1:])
+        lo = 2 * np.searchsorted(edges, roi_lims[:, 0]) + 2
+        hi = 2 * np.searchsorted(edges, roi_lims[:, 1]) + 1
+        counts = csum[:, hi] - csum[:, lo]
+        return np.maximum(counts, 0)
+
     def histogram_between_times(self, start, stop, e_bins, channels=None, offset=0):
         energies = self.select_between_times(start, stop, channels=channels)
         ehist, _ = np.histogram(energies - offset, e_bins)
         return ehist
 
+    def histogram_points_between_times(
+        self, starts, stops, e_bins, channels=None, offsets=None
+    ):
+        """
+        Histogram the energies of every scan point in a single pass
+
+        starts, stops : arrays of scan point start and stop times
+        e_bins : energy bin edges, as for np.histogram
+        channels : optional list of channels to include
+        offsets : optional per-point energy offsets, subtracted from the
+                  energies before binning
+
+        Returns an (n_points, n_bins) array of counts
+        """
+        e_bins = np.asarray(e_bins)
+        npts = len(np.atleast_1d(starts))
+        nbins = len(e_bins) - 1
+        photon_idx, point_idx = self.photons_between_times(starts, stops, channels)
+        e = self.energies[photon_idx]
+        if offsets is not None:
+            e = e - np.asarray(offsets, dtype=float)[point_idx]
+        # Bins are half-open except the last, which includes its right edge,
+        # as in np.histogram
+        bin_idx = np.searchsorted(e_bins, e, side="right") - 1
+        bin_idx[e == e_bins[-1]] = nbins - 1
+        valid = (bin_idx >= 0) & (bin_idx < nbins)
+        hist = np.bincount(
+            point_idx[valid] * nbins + bin_idx[valid], minlength=npts * nbins
+        )
+        return hist.reshape(npts, nbins)
+
 
 class LogData:
     def __init__(self, start_times, stop_times, motor_name, motor_vals):
@@ -59,22 +401,44 @@ class LogData:
         self.motor_name = motor_name
         self.motor_vals = motor_vals
 
+    @property
+    def nbytes(self):
+        return sum(
+            _array_nbytes(a)
+            for a in [self.start_times, self.stop_times, self.motor_vals]
+        )
+
 
 class ScanData:
     def __init__(self, data, log):
         self.data = data
         self.log = log
 
+    @property
+    def nbytes(self):
+        return self.data.nbytes + self.log.nbytes
+
     def getScan1d(self, llim, ulim, channels=None):
-        counts = np.zeros_like(self.log.start_times)
-        for n in range(len(counts)):
-            counts[n] = self.data.sum_roi_between_times(
-                self.log.start_times[n],
-                self.log.stop_times[n],
-                llim,
-                ulim,
-                channels=channels,
-            )
+        counts = self.data.sum_rois_between_times(
+            self.log.start_times,
+            self.log.stop_times,
+            [(llim, ulim)],
+            channels=channels,
+        )
+        return counts[:, 0], self.log.motor_vals
+
+    def getScan1dRois(self, rois, channels=None):
+        """
+        rois : list of (llim, ulim) tuples
+
+        Returns an (n_points, n_rois) array of counts, and the motor values
+        """
+        counts = self.data.sum_rois_between_times(
+            self.log.start_times,
+            self.log.stop_times,
+            rois,
+            channels=channels,
+        )
         return counts, self.log.motor_vals
 
     def getScan2d(self, llim, ulim, eres=0.3, channels=None, eloss=False):
@@ -84,17 +448,15 @@ class ScanData:
         e_centers = (e_bins[1:] + e_bins[:-1]) / 2
 
         mono_grid, energy_grid = np.meshgrid(mono_list, e_centers)
-        counts = np.zeros_like(mono_grid)
-        for n, m in enumerate(mono_list):
-            offset = m if eloss else 0
-            counts[:, n] = self.data.histogram_between_times(
-                self.log.start_times[n],
-                self.log.stop_times[n],
-                e_bins,
-                channels=channels,
-                offset=offset,
-            )
-        return counts, mono_grid, energy_grid
+        offsets = mono_list if eloss else None
+        counts = self.data.histogram_points_between_times(
+            self.log.start_times,
+            self.log.stop_times,
+            e_bins,
+            channels=channels,
+            offsets=offsets,
+        )
+        return counts.T, mono_grid, energy_grid
 
     def getEmission(
         self, llim, ulim, eres=0.3, strictTimebins=False, channels=None, **kwargs
@@ -128,9 +490,222 @@ class ScanData:
         return mono_arr, emission_arr
 
 
-def data_from_file(filename):
+def save_processed_arrays(
+    savefile, timestamps, energies, channels, block_size=TIME_INDEX_BLOCK
+):
+    """
+    Save a processed photon list as a directory of uncompressed .npy
+    columns, so that it can be memory-mapped by data_from_file, along with
+    a coarse time index
+
+    timestamps : integer nanosecond timestamps, sorted
+    block_size : number of photons per time index block
+    """
+    if not os.path.exists(savefile):
+        os.makedirs(savefile)
+    columns = {"timestamps": timestamps, "energies": energies, "channels": channels}
+    for name in PROCESSED_COLUMNS:
+        np.save(join(savefile, f"{name}.npy"), columns[name])
+    index = make_time_index(timestamps, energies, channels, block_size)
+    np.savez(join(savefile, TIME_INDEX_FILE), **index)
+
+
+def save_processed_streams(
+    savefile, streams, chunksize=2**22, block_size=TIME_INDEX_BLOCK
+):
+    """
+    Merge per-channel photon streams and write them to disk in chunks, so
+    that the merged photon list is never held in memory
+
+    streams : list of (timestamps, energies, channum) tuples, each sorted
+              in time, or (timestamps, energies, channum, filtvalues) tuples
+              to also save a filtvalues column
+    chunksize : approximate number of photons merged and written at once
+    """
+    if not os.path.exists(savefile):
+        os.makedirs(savefile)
+    streams = [s for s in streams if len(s[0]) > 0]
+    total = sum(len(s[0]) for s in streams)
+    ts_dtype = streams[0][0].dtype if streams else np.int64
+    en_dtype = streams[0][1].dtype if streams else np.float64
+    columns = {
+        "timestamps": ts_dtype,
+        "energies": en_dtype,
+        "channels": np.int32,
+    }
+    names = list(PROCESSED_COLUMNS)
+    if streams and len(streams[0]) > 3:
+        columns[FILTVALUE_COLUMN] = streams[0][3].dtype
+        names.append(FILTVALUE_COLUMN)
+    # Optional columns of an earlier save would no longer match the photons
+    stale = join(savefile, f"{FILTVALUE_COLUMN}.npy")
+    if FILTVALUE_COLUMN not in names and exists(stale):
+        os.remove(stale)
+    out = {
+        name: np.lib.format.open_memmap(
+            join(savefile, f"{name}.npy"),
+            mode="w+",
+            dtype=columns[name],
+            shape=(total,),
+        )
+        for name in names
+    }
+    kway_merge(
+        [s[0] for s in streams],
+        [[s[n] for s in streams] for n in range(1, len(names))],
+        out=[out[name] for name in names],
+        chunksize=chunksize,
+    )
+    for arr in out.values():
+        arr.flush()
+    chanlist = [s[2] for s in streams]
+    index = make_time_index(
+        out["timestamps"],
+        out["energies"],
+        out["channels"],
+        block_size,
+        chanlist=chanlist,
+    )
+    np.savez(join(savefile, TIME_INDEX_FILE), **index)
+    del out
+
+
+def _read_npy_header(f):
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    return version, shape, dtype, f.tell()
+
+
+def _npy_length(filename):
+    with open(filename, "rb") as f:
+        _, shape, _, _ = _read_npy_header(f)
+    return shape[0]
+
+
+def _write_npy_tail(filename, start, values):
+    """
+    Overwrite a 1-d .npy file from element start onwards with values, growing
+    the file as needed. The header is rewritten in place, which relies on
+    the spare space numpy leaves in headers for growing arrays.
+    """
+    with open(filename, "r+b") as f:
+        version, shape, dtype, offset = _read_npy_header(f)
+        length = start + len(values)
+        if length < shape[0]:
+            raise ValueError(f"Appending to {filename} would shrink it")
+        header = io.BytesIO()
+        d = {
+            "descr": np.lib.format.dtype_to_descr(dtype),
+            "fortran_order": False,
+            "shape": (int(length),),
+        }
+        if version == (1, 0):
+            np.lib.format.write_array_header_1_0(header, d)
+        else:
+            np.lib.format.write_array_header_2_0(header, d)
+        if len(header.getvalue()) != offset:
+            raise ValueError(f"Header of {filename} cannot be grown in place")
+        f.seek(offset + start * dtype.itemsize)
+        f.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+        f.seek(0)
+        f.write(header.getvalue())
+
+
+def append_processed_streams(savefile, streams, block_size=TIME_INDEX_BLOCK):
+    """
+    Add new photons to a processed data directory written by
+    save_processed_streams, keeping it sorted in time
+
+    streams : list of (timestamps, energies, channum) tuples of new photons,
+              each sorted in time. If the directory has a filtvalues column,
+              the tuples must be (timestamps, energies, channum, filtvalues).
+
+    Photons already on disk that are later than the earliest new photon
+    are merged with the new ones and rewritten, so only the tail of each
+    column and of the time index is touched.
+    """
+    streams = [s for s in streams if len(s[0]) > 0]
+    if not streams:
+        return
+    names = list(PROCESSED_COLUMNS)
+    if exists(join(savefile, f"{FILTVALUE_COLUMN}.npy")):
+        if len(streams[0]) < 4:
+            raise ValueError(f"{savefile} has {FILTVALUE_COLUMN}, streams do not")
+        names.append(FILTVALUE_COLUMN)
+    new = kway_merge(
+        [s[0] for s in streams],
+        [[s[n] for s in streams] for n in range(1, len(names))],
+    )
+    files = {name: join(savefile, f"{name}.npy") for name in names}
+    old = {name: np.load(files[name], mmap_mode="r") for name in names}
+    keep = np.searchsorted(old["timestamps"], new[0][0], side="right")
+    merged = kway_merge(
+        [np.asarray(old["timestamps"][keep:]), new[0]],
+        [[np.asarray(old[name][keep:]), new[n]] for n, name in enumerate(names) if n],
+    )
+    del old
+    for name, values in zip(names, merged):
+        _write_npy_tail(files[name], keep, values)
+    ch = merged[2]
+
+    # Only the blocks from the first rewritten photon onwards change
+    columns = {name: np.load(files[name], mmap_mode="r") for name in PROCESSED_COLUMNS}
+    old_index = load_time_index(savefile)
+    if old_index is None or old_index["block_size"] != block_size:
+        b0 = 0
+        old_channels = np.zeros(0, dtype=ch.dtype)
+    else:
+        b0 = keep // block_size
+        old_channels = old_index["block_channels"]
+    chanlist = np.union1d(old_channels, [s[2] for s in streams])
+    start = b0 * block_size
+    index = make_time_index(
+        columns["timestamps"][start:],
+        columns["energies"][start:],
+        columns["channels"][start:],
+        block_size,
+        chanlist=chanlist,
+    )
+    if b0 > 0:
+        old_counts = np.zeros((b0, len(chanlist)), dtype=np.int64)
+        old_counts[:, np.searchsorted(chanlist, old_channels)] = old_index[
+            "block_counts"
+        ][:b0]
+        for key in ["block_times", "block_emin", "block_emax"]:
+            index[key] = np.concatenate([old_index[key][:b0], index[key]])
+        index["block_counts"] = np.concatenate([old_counts, index["block_counts"]])
+    del columns
+    np.savez(join(savefile, TIME_INDEX_FILE), **index)
+
+
+def load_time_index(filename):
+    indexfile = join(filename, TIME_INDEX_FILE)
+    if not exists(indexfile):
+        return None
+    with np.load(indexfile) as f:
+        index = {k: f[k] for k in f.files}
+    index["block_size"] = int(index["block_size"])
+    return index
+
+
+def data_from_file(filename, mmap_mode="r"):
+    """
+    filename : A processed data directory, or a legacy .npz file
+    mmap_mode : passed to np.load for the columns of a processed data directory
+    """
+    if os.path.isdir(filename):
+        columns = [
+            np.load(join(filename, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in PROCESSED_COLUMNS
+        ]
+        return ProcessedData(
+            *columns, index=load_time_index(filename), filename=filename
+        )
     data = np.load(filename)
-    timestamps = data["timestamps"] * 1e-9  # data is stored as nanoseconds
+    timestamps = data["timestamps"]  # data is stored as nanoseconds
     energies = data["energies"]
     channels = data["channels"]
     return ProcessedData(timestamps, energies, channels)
@@ -166,16 +741,110 @@ def log_from_run(run):
     return LogData(start_time, stop_time, motor_name, motor_vals)
 
 
-def scandata_from_run(run, logtype="json"):
-    filename = get_analyzed_filename(run)
-    if not exists(filename):
-        filename = get_analyzed_filename_old(run)
+def _array_nbytes(a):
+    if isinstance(a, np.memmap):
+        return 0
+    return np.asarray(a).nbytes
+
+
+def _processed_mtime(filename):
+    """
+    Newest modification time, in ns, of the files of a processed data
+    directory, or of a legacy .npz file. Appending rewrites every column,
+    but recalibrating only rewrites the energies and the time index.
+    """
+    if os.path.isdir(filename):
+        names = [f"{name}.npy" for name in PROCESSED_COLUMNS]
+        names += [f"{FILTVALUE_COLUMN}.npy", TIME_INDEX_FILE]
+        files = [join(filename, name) for name in names]
+    else:
+        files = [filename]
+    mtimes = [os.stat(f).st_mtime_ns for f in files if exists(f)]
+    if not mtimes:
+        return None
+    return max(mtimes)
+
+
+class ScanDataCache:
+    """
+    Process-wide LRU cache of ScanData objects, keyed by
+    (run uid, processed file, logtype) and the processed file mtime, and
+    evicted by approximate memory size
+    """
+
+    def __init__(self, max_bytes=2 * 1024**3):
+        """
+        max_bytes : memory budget for cached objects
+        """
+        self.max_bytes = max_bytes
+        self._cache = OrderedDict()
+
+    def get(self, key, mtime):
+        if key not in self._cache:
+            return None
+        cached_mtime, sd = self._cache[key]
+        if cached_mtime != mtime:
+            # The processed file has been rewritten or appended to
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return sd
+
+    def put(self, key, mtime, sd):
+        self._cache[key] = (mtime, sd)
+        self._cache.move_to_end(key)
+        self.evict()
+
+    def evict(self):
+        # Sizes are recomputed, since indices are built lazily after caching
+        sizes = {key: sd.nbytes for key, (_, sd) in self._cache.items()}
+        total = sum(sizes.values())
+        while total > self.max_bytes and len(self._cache) > 1:
+            key, _ = self._cache.popitem(last=False)
+            total -= sizes[key]
+
+    def clear(self):
+        self._cache.clear()
+
+    @property
+    def nbytes(self):
+        return sum(sd.nbytes for _, sd in self._cache.values())
+
+
+SCANDATA_CACHE = ScanDataCache()
+
+
+def set_scandata_cache_size(max_bytes):
+    """
+    Set the memory budget of the ScanData cache used by scandata_from_run
+    """
+    SCANDATA_CACHE.max_bytes = max_bytes
+    SCANDATA_CACHE.evict()
+
+
+def scandata_from_run(run, logtype="json", cache=True):
+    """
+    run : a bluesky run with processed TES data
+    logtype : "json" to read the scan log file, or "run" to use the run streams
+    cache : If True, re-use ScanData from SCANDATA_CACHE when the processed
+            file has not changed
+    """
+    filename = find_analyzed_filename(run)
+    key = (run.start["uid"], filename, logtype)
+    mtime = _processed_mtime(filename)
+    if cache:
+        sd = SCANDATA_CACHE.get(key, mtime)
+        if sd is not None:
+            return sd
     data = data_from_file(filename)
     if logtype == "run":
         log = log_from_run(run)
     else:
         log = log_from_json(run)
-    return ScanData(data, log)
+    sd = ScanData(data, log)
+    if cache:
+        SCANDATA_CACHE.put(key, mtime, sd)
+    return sd
 
 
 def plotScan1d(run, llim, ulim, channels=None, logtype="json"):
@@ -201,11 +870,39 @@ def get_analyzed_filename(run):
     savedir = get_save_directory(run)
     prefix = "_".join(basename(get_filename(run)).split("_")[:2])
     state = get_tes_state(run)
-    return join(savedir, f"{prefix}_{state}.npz")
+    return join(savedir, f"{prefix}_{state}")
+
+
+def existing_processed_file(savefile, state):
+    """
+    savefile : processed data directory, from get_analyzed_filename
+    state : TES state of the run
+
+    Returns savefile if it exists, or else the legacy .npz file of the same
+    run if that exists, or None
+    """
+    for candidate in [
+        savefile,
+        savefile + ".npz",
+        join(dirname(savefile), f"tes_{state}.npz"),
+    ]:
+        if exists(candidate):
+            return candidate
+    return None
+
+
+def find_analyzed_filename(run):
+    """
+    Returns the processed data for a run, falling back to the legacy .npz
+    files if the columnar directory does not exist
+    """
+    filename = get_analyzed_filename(run)
+    existing = existing_processed_file(filename, get_tes_state(run))
+    return filename if existing is None else existing
 
 
 def is_run_processed(run):
-    filename = get_analyzed_filename(run)
+    filename = find_analyzed_filename(run)
     if os.path.exists(filename):
         return True
     else: